@@ -0,0 +1,119 @@
+''' Admission control of uploads.
+
+An upload is let in, before its body is read, only if fewer than
+UPLOAD_CONCURRENCY uploads run in the process and fewer than
+UPLOAD_CONCURRENCY_GLOBAL across the processes sharing UPLOAD_DIR (each of
+which holds the flock of one of as many .admission<n> files), and if
+UPLOAD_DIR has room for its declared length, on top of UPLOAD_DISK_MARGIN
+and of the uploads running in the process. Other uploads are answered 503
+with Retry-After, so that clients back off rather than slow every transfer
+down. '''
+
+import errno
+import fcntl
+import os
+import threading
+
+import app_settings as settings
+
+
+class Overloaded(Exception):
+    ''' an upload is refused for the time being '''
+
+
+_lock = threading.Lock()
+_semaphore = None
+_semaphore_key = None
+# Declared length of the uploads running in the process
+_reserved = 0
+
+
+def get_semaphore():
+    ''' returns the semaphore of the uploads running in the process, or None
+    without limit '''
+    global _semaphore, _semaphore_key
+    size = settings.UPLOAD_CONCURRENCY
+    if not size:
+        return None
+    # A semaphore inherited from a forked parent counts its uploads
+    key = (size, os.getpid())
+    with _lock:
+        if _semaphore_key != key:
+            _semaphore = threading.BoundedSemaphore(size)
+            _semaphore_key = key
+        return _semaphore
+
+
+def make_upload_dir():
+    ''' creates UPLOAD_DIR, which no file may have been uploaded to yet '''
+    try:
+        os.makedirs(settings.UPLOAD_DIR)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def acquire_slot():
+    ''' returns the locked file of a free cross-process slot, or None '''
+    for number in range(settings.UPLOAD_CONCURRENCY_GLOBAL):
+        lock_file = open(os.path.join(
+            settings.UPLOAD_DIR, '.admission%d' % number), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+        else:
+            return lock_file
+    return None
+
+
+class Admission(object):
+    ''' the slots, and disk space, held by an admitted upload '''
+
+    def __init__(self, semaphore):
+        self.semaphore = semaphore
+        self.lock_file = None
+        self.reserved = 0
+
+    def release(self):
+        global _reserved
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+        if self.reserved:
+            with _lock:
+                _reserved -= self.reserved
+            self.reserved = 0
+        if self.semaphore is not None:
+            self.semaphore.release()
+            self.semaphore = None
+
+
+def admit(length):
+    ''' admits an upload of length declared bytes (0 if unknown) and returns
+    its Admission, to release once done. Raises Overloaded if it is refused.
+    '''
+    global _reserved
+    semaphore = get_semaphore()
+    if semaphore is not None and not semaphore.acquire(False):
+        raise Overloaded('Too many uploads in progress')
+    admission = Admission(semaphore)
+    try:
+        if settings.UPLOAD_CONCURRENCY_GLOBAL or length:
+            make_upload_dir()
+        if settings.UPLOAD_CONCURRENCY_GLOBAL:
+            admission.lock_file = acquire_slot()
+            if admission.lock_file is None:
+                raise Overloaded('Too many uploads in progress')
+        if length and settings.UPLOAD_DISK_MARGIN is not None:
+            with _lock:
+                stat = os.statvfs(settings.UPLOAD_DIR)
+                if stat.f_bavail * stat.f_frsize - _reserved - length < \
+                        settings.UPLOAD_DISK_MARGIN:
+                    raise Overloaded('Not enough disk space')
+                _reserved += length
+                admission.reserved = length
+    except:
+        admission.release()
+        raise
+    return admission
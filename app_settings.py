@@ -4,9 +4,123 @@ from django.conf import settings
 
 UPLOAD_DIR = join(settings.MEDIA_ROOT, 'secure_storage')
 
+# Files are stored in SHARD_DEPTH levels of directories named after
+# SHARD_WIDTH characters of their id, e.g. ab/cd/abcd... for 2 and 2.
+# 0 stores files flat in UPLOAD_DIR. Run shard_secure_storage after
+# changing the layout.
+SHARD_DEPTH = 2
+SHARD_WIDTH = 2
+
 MB = 1024 * 1024
 UPLOAD_FILE_SIZE_LIMIT = 100 * MB
 
+# Resumable uploads (see models.UploadSession) can be larger. Unfinished
+# upload sessions expire after UPLOAD_SESSION_TTL seconds.
+RESUMABLE_UPLOAD_SIZE_LIMIT = 10 * 1024 * MB
+UPLOAD_SESSION_TTL = 24 * 3600
+
+# On-disk format of new uploads: 'segmented' (independently encrypted and
+# authenticated segments, see segments.py) or 'cbc' (legacy single stream).
+# Both formats can always be read.
+FILE_FORMAT = 'segmented'
+SEGMENT_SIZE = 64 * 1024
+
+# Compression of new segmented files ahead of encryption: None, 'zlib' or
+# 'zstd' (requires the zstandard package). Files whose content type starts
+# with one of INCOMPRESSIBLE_TYPES are stored as they are.
+COMPRESSION = None
+COMPRESSION_LEVEL = 6
+INCOMPRESSIBLE_TYPES = (
+    'image/', 'video/', 'audio/', 'application/zip', 'application/gzip',
+    'application/x-gzip', 'application/x-bzip2', 'application/x-xz',
+    'application/x-7z-compressed', 'application/x-rar-compressed',
+    'application/zstd', 'application/pdf')
+
+# Where new files keep their IV, size, name and content type: 'database', or
+# 'header' (sealed in the header of the file itself, segmented format only),
+# in which case the database only holds their expiry and one-time state.
+METADATA_STORAGE = 'database'
+
+# Cache alias (see django's CACHES) the metadata rows are cached in for
+# METADATA_CACHE_TTL seconds, or None.
+METADATA_CACHE = None
+METADATA_CACHE_TTL = 300
+
+# AES engine: 'pycryptodome', 'openssl' (requires the cryptography package)
+# or the dotted path to an engine class, see backends.py.
+CIPHER_BACKEND = 'pycryptodome'
+
+# Key derivation for new files: 'pbkdf2_sha256' (salted with the file IV) or
+# 'sha256' (legacy, unsalted). The KDF of each file is recorded with it.
+KDF = 'pbkdf2_sha256'
+KDF_ITERATIONS = 100000
+
+# Derived keys are cached for KEY_CACHE_TTL seconds, at most KEY_CACHE_SIZE
+# of them (0 disables the cache).
+KEY_CACHE_SIZE = 256
+KEY_CACHE_TTL = 60
+
+# Random bytes drawn from os.urandom at once to serve IVs, nonces and ids.
+ENTROPY_POOL_SIZE = 4096
+
+# Threads used to encrypt/decrypt segments in parallel (1 disables the pool).
+CRYPTO_THREADS = 4
+
+# Downloads are read, decrypted and sent DOWNLOAD_CHUNK_SIZE bytes at a time
+# (rounded down to a whole number of segments for segmented files).
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+# Downloads read and decrypt up to DOWNLOAD_PIPELINE_DEPTH chunks (and at
+# most DOWNLOAD_PIPELINE_MAX_BYTES) ahead of the client in a background
+# thread. 0 disables the pipeline.
+DOWNLOAD_PIPELINE_DEPTH = 0
+DOWNLOAD_PIPELINE_MAX_BYTES = 8 * MB
+
+# Files at most in one batch (ZIP) download.
+BATCH_DOWNLOAD_LIMIT = 500
+
+# Where transfer metrics go (see metrics.py): None, 'prometheus' (served
+# in process by MetricsView), 'statsd' or the dotted path to a sink class.
+METRICS_SINK = None
+# Fraction of the transfers measured.
+METRICS_SAMPLE_RATE = 1.0
+# Logs the stage breakdown of every measured transfer.
+METRICS_LOG = False
+# Address and metric name prefix of the statsd sink.
+METRICS_STATSD_ADDRESS = ('localhost', 8125)
+METRICS_STATSD_PREFIX = 'secure_storage'
+
+# Uploads encrypted at once in a process, and across the processes sharing
+# UPLOAD_DIR (0 for no limit), see admission.py. Uploads past either limit
+# are answered 503, before their body is read, and told to retry after
+# UPLOAD_RETRY_AFTER seconds.
+UPLOAD_CONCURRENCY = 0
+UPLOAD_CONCURRENCY_GLOBAL = 0
+UPLOAD_RETRY_AFTER = 5
+# Free space kept in UPLOAD_DIR: uploads whose declared length does not fit
+# above it are refused. None disables the check.
+UPLOAD_DISK_MARGIN = 0
+
+# Buffer size of the encrypted files written, None for the io default.
+WRITE_BUFFER_SIZE = 1 * MB
+# Preallocates new files from their declared length (posix_fallocate).
+PREALLOCATE = True
+# When written files are synced to disk: None, 'close' (before they are
+# renamed into place) or 'periodic' (also every FSYNC_INTERVAL bytes).
+FSYNC = None
+FSYNC_INTERVAL = 64 * MB
+
+# Removes files in a background thread as they expire (see reaper.py),
+# rather than leaving them to clean_secure_storage.
+REAPER = False
+# Seconds between loads of the upcoming expiry dates.
+REAPER_INTERVAL = 60
+# Expiry dates loaded at most at once, and files removed per query.
+REAPER_HEAP_SIZE = 100000
+REAPER_BATCH_SIZE = 500
+# Seconds after a claim (one-time download) its file is removed.
+REAPER_GRACE = 300
+
 UPLOAD_DOMAIN = 'http://localhost:8000'
 
 
@@ -0,0 +1,143 @@
+''' AES engines.
+
+encryption.py does all of its AES work through the engine selected by
+app_settings.CIPHER_BACKEND. An engine provides:
+
+    cbc(key, iv)
+        a stateful AES-CBC cipher object with encrypt(data, output=None) and
+        decrypt(data, output=None) methods, as PyCryptodome's.
+
+    gcm_encrypt(key, nonce, data, aad, output=None)
+        returns ciphertext + tag, or writes them into output.
+
+    gcm_decrypt(key, nonce, sealed, aad, output=None)
+        takes ciphertext + tag, returns the plaintext or writes it into
+        output. Raises ValueError if authentication fails.
+'''
+
+TAG_SIZE = 16
+
+
+def as_bytes(data):
+    ''' returns data as a string, copying it if it is a buffer '''
+    if isinstance(data, bytes):
+        return data
+    return memoryview(data).tobytes()
+
+
+class PyCryptodomeBackend(object):
+    ''' PyCryptodome (Crypto.Cipher.AES) engine '''
+
+    name = 'pycryptodome'
+
+    def __init__(self):
+        from Crypto.Cipher import AES
+        self.AES = AES
+
+    def cbc(self, key, iv):
+        return self.AES.new(key, self.AES.MODE_CBC, iv)
+
+    def gcm_encrypt(self, key, nonce, data, aad, output=None):
+        cipher = self.AES.new(key, self.AES.MODE_GCM, nonce=nonce)
+        cipher.update(aad)
+        if output is None:
+            ciphertext, tag = cipher.encrypt_and_digest(data)
+            return ciphertext + tag
+        cipher.encrypt(data, output=output[:len(data)])
+        output[len(data):len(data) + TAG_SIZE] = cipher.digest()
+        return output
+
+    def gcm_decrypt(self, key, nonce, sealed, aad, output=None):
+        cipher = self.AES.new(key, self.AES.MODE_GCM, nonce=nonce)
+        cipher.update(aad)
+        plaintext = cipher.decrypt(sealed[:-TAG_SIZE], output=output)
+        cipher.verify(sealed[-TAG_SIZE:])
+        return output if output is not None else plaintext
+
+
+class OpenSSLCBC(object):
+    ''' PyCryptodome-like AES-CBC cipher object over cryptography's
+    one-way encryptor and decryptor contexts '''
+
+    def __init__(self, cipher):
+        self.cipher = cipher
+        self.encryptor = None
+        self.decryptor = None
+        self.buffer = bytearray()
+
+    def _update(self, context, data, output):
+        if output is None:
+            return context.update(data)
+        # update_into() needs block_size - 1 bytes of room past the data
+        if len(self.buffer) < len(data) + 15:
+            self.buffer = bytearray(len(data) + 15)
+        count = context.update_into(data, self.buffer)
+        output[:count] = memoryview(self.buffer)[:count]
+
+    def encrypt(self, data, output=None):
+        if self.encryptor is None:
+            self.encryptor = self.cipher.encryptor()
+        return self._update(self.encryptor, data, output)
+
+    def decrypt(self, data, output=None):
+        if self.decryptor is None:
+            self.decryptor = self.cipher.decryptor()
+        return self._update(self.decryptor, data, output)
+
+
+class OpenSSLBackend(object):
+    ''' cryptography (OpenSSL) engine, using AES-NI where available '''
+
+    name = 'openssl'
+
+    def __init__(self):
+        from cryptography.exceptions import InvalidTag
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives.ciphers import (
+            Cipher, algorithms, modes)
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        self.InvalidTag = InvalidTag
+        self.backend = default_backend()
+        self.Cipher, self.algorithms, self.modes = Cipher, algorithms, modes
+        self.AESGCM = AESGCM
+
+    def cbc(self, key, iv):
+        return OpenSSLCBC(self.Cipher(
+            self.algorithms.AES(key), self.modes.CBC(iv),
+            backend=self.backend))
+
+    # AESGCM only takes strings, but it is much faster than the streaming
+    # Cipher API on segment-sized data, copies included.
+
+    def gcm_encrypt(self, key, nonce, data, aad, output=None):
+        sealed = self.AESGCM(key).encrypt(nonce, as_bytes(data), aad)
+        if output is None:
+            return sealed
+        output[:len(sealed)] = sealed
+        return output
+
+    def gcm_decrypt(self, key, nonce, sealed, aad, output=None):
+        try:
+            plaintext = self.AESGCM(key).decrypt(
+                as_bytes(nonce), as_bytes(sealed), aad)
+        except self.InvalidTag:
+            raise ValueError('MAC check failed')
+        if output is None:
+            return plaintext
+        output[:len(plaintext)] = plaintext
+        return output
+
+
+BACKENDS = {
+    'pycryptodome': PyCryptodomeBackend,
+    'openssl': OpenSSLBackend,
+}
+
+
+def load_backend(name):
+    ''' returns an engine instance, from its BACKENDS name or a dotted path
+    to an engine class '''
+    if name in BACKENDS:
+        return BACKENDS[name]()
+    from django.utils.module_loading import import_string
+    return import_string(name)()
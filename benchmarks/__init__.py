@@ -0,0 +1,30 @@
+''' Benchmarks for secure_storage.
+
+Run them from the directory holding the secure_storage package, e.g.:
+
+    python -m secure_storage.benchmarks.multipart --size 100
+'''
+
+import os
+import tempfile
+
+
+def setup_django(**overrides):
+    ''' configures a throwaway project, with the given settings, when not run
+    from within one. Returns whether it did. '''
+    import django
+    from django.conf import settings
+
+    configure = not settings.configured and \
+        'DJANGO_SETTINGS_MODULE' not in os.environ
+    if configure:
+        options = dict(
+            MEDIA_ROOT=tempfile.mkdtemp(),
+            INSTALLED_APPS=[__name__.rsplit('.', 1)[0]],
+            DATABASES={'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': ':memory:'}})
+        options.update(overrides)
+        settings.configure(**options)
+    django.setup()
+    return configure
@@ -0,0 +1,78 @@
+''' clean_secure_storage benchmark: time and queries to sweep a storage of
+--files files, a third of them live, a third expired and a third without
+metadata. Files are a few bytes long: only the scan, the metadata lookups
+and the unlinks are measured. '''
+
+from __future__ import absolute_import
+
+import optparse
+import os
+import shutil
+import time
+from datetime import timedelta
+from StringIO import StringIO
+
+from . import setup_django
+
+
+def populate(count):
+    ''' creates count files and the metadata of two thirds of them '''
+    from django.utils.timezone import now
+    from ..entropy import new_file_id
+    from ..models import EncryptedUploadedFileMetaData
+    from ..storage import EncryptedFileSystemStorage
+
+    storage = EncryptedFileSystemStorage()
+    old = time.time() - 86400
+    rows = []
+    for i in range(count):
+        file_id = new_file_id()
+        path = storage.path(file_id)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'wb') as file_:
+            file_.write('data')
+        os.utime(path, (old, old))
+        if i % 3:
+            rows.append(EncryptedUploadedFileMetaData(
+                file_id=file_id, encrypted_name='name', iv='iv',
+                expire_date=now() + timedelta(
+                    days=1 if i % 3 == 1 else -1)))
+    EncryptedUploadedFileMetaData.objects.bulk_create(rows, batch_size=500)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--files', type='int', default=30000)
+    parser.add_option('--batch-size', type='int', default=900)
+    parser.add_option('--workers', type='int', default=8)
+    options, args = parser.parse_args()
+
+    throwaway = setup_django()
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    if throwaway:
+        call_command('migrate', interactive=False, verbosity=0)
+    populate(options.files)
+    output = StringIO()
+    try:
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            call_command(
+                'clean_secure_storage', batch_size=options.batch_size,
+                workers=options.workers, stdout=output)
+            elapsed = time.time() - start
+    finally:
+        if throwaway:
+            shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+    print(output.getvalue().strip())
+    print('%d files in %.2fs: %.0f files/s, %d queries' % (
+        options.files, elapsed, options.files / elapsed, len(queries)))
+
+
+if __name__ == '__main__':
+    main()
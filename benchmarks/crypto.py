@@ -0,0 +1,144 @@
+''' AES engine micro-benchmark: MB/s per engine, mode and chunk size, using
+the same calls (and output buffers) as the upload and download paths.
+
+With --encryption, the encryption.py entry points are measured instead
+with the configured engine: key derivation (uncached and cached) and
+segment encryption and decryption at SEGMENT_SIZE. '''
+
+from __future__ import absolute_import
+
+import optparse
+import os
+import time
+
+from . import setup_django
+from ..backends import BACKENDS, TAG_SIZE, load_backend
+
+
+MB = 1024 * 1024
+CHUNK_SIZES = (4 * 1024, 64 * 1024, MB)
+
+
+def cbc_encrypt(backend, key, data, output):
+    cipher = backend.cbc(key, os.urandom(16))
+
+    def run():
+        cipher.encrypt(data, output=output[:len(data)])
+    return run
+
+
+def cbc_decrypt(backend, key, data, output):
+    cipher = backend.cbc(key, os.urandom(16))
+
+    def run():
+        cipher.decrypt(data, output=output[:len(data)])
+    return run
+
+
+def gcm_encrypt(backend, key, data, output):
+    nonce = os.urandom(12)
+
+    def run():
+        backend.gcm_encrypt(
+            key, nonce, data, 'aad', output[:len(data) + TAG_SIZE])
+    return run
+
+
+def gcm_decrypt(backend, key, data, output):
+    nonce = os.urandom(12)
+    sealed = memoryview(backend.gcm_encrypt(key, nonce, data, 'aad'))
+
+    def run():
+        backend.gcm_decrypt(key, nonce, sealed, 'aad', output[:len(data)])
+    return run
+
+
+MODES = (
+    ('cbc-encrypt', cbc_encrypt),
+    ('cbc-decrypt', cbc_decrypt),
+    ('gcm-encrypt', gcm_encrypt),
+    ('gcm-decrypt', gcm_decrypt),
+)
+
+
+def measure(run, chunk_size, total):
+    count = max(total // chunk_size, 1)
+    start = time.time()
+    for i in range(count):
+        run()
+    return count * chunk_size / (time.time() - start) / MB
+
+
+def measure_calls(run, seconds=1.0):
+    ''' returns how many times per second run() completes '''
+    count = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        run()
+        count += 1
+    return count / (time.time() - start)
+
+
+def encryption(total):
+    ''' measures the encryption.py entry points '''
+    setup_django()
+    from .. import app_settings as settings
+    from ..encryption import (
+        current_kdf, decrypt_segment, derive_key, encrypt_segment, get_key)
+    from ..segments import OVERHEAD
+
+    passphrase, salt, kdf = 'x' * 32, os.urandom(16), current_kdf()
+    get_key(passphrase, salt, kdf)
+    print('%-28s %10.1f /s' % ('derive_key %s' % (kdf or 'sha256'),
+          measure_calls(lambda: derive_key(passphrase, salt, kdf))))
+    print('%-28s %10.1f /s' % ('get_key (cached)', measure_calls(
+        lambda: get_key(passphrase, salt, kdf))))
+
+    key = get_key(passphrase, salt, kdf)
+    size = settings.SEGMENT_SIZE
+    data = memoryview(os.urandom(size))
+    output = memoryview(bytearray(size + OVERHEAD))
+    sealed = memoryview(encrypt_segment(key, 0, data))
+    plain = memoryview(bytearray(size))
+    print('%-28s %10.1f MB/s' % ('encrypt_segment %dK' % (size // 1024),
+          measure(lambda: encrypt_segment(key, 0, data, False, output),
+                  size, total)))
+    print('%-28s %10.1f MB/s' % ('decrypt_segment %dK' % (size // 1024),
+          measure(lambda: decrypt_segment(key, 0, sealed, False, plain),
+                  size, total)))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--total', type='int', default=64,
+                      help='MB processed per measurement')
+    parser.add_option('--backend', action='append', dest='backends',
+                      help='engine to measure (default: all available)')
+    parser.add_option('--encryption', action='store_true', default=False,
+                      help='measure encryption.py instead of the engines')
+    options, args = parser.parse_args()
+
+    if options.encryption:
+        encryption(options.total * MB)
+        return
+
+    key = os.urandom(32)
+    output = memoryview(bytearray(max(CHUNK_SIZES) + TAG_SIZE))
+    print('%-14s %-12s %10s %10s' % ('engine', 'mode', 'chunk', 'MB/s'))
+    for name in options.backends or sorted(BACKENDS):
+        try:
+            backend = load_backend(name)
+        except ImportError as e:
+            print('%-14s unavailable: %s' % (name, e))
+            continue
+        for mode, setup in MODES:
+            for chunk_size in CHUNK_SIZES:
+                data = memoryview(os.urandom(chunk_size))
+                run = setup(backend, key, data, output)
+                print('%-14s %-12s %9dK %10.1f' % (
+                    name, mode, chunk_size // 1024,
+                    measure(run, chunk_size, options.total * MB)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,469 @@
+''' End-to-end load test: files are uploaded through UploadSecureStorageView
+then downloaded through DownloadSecureStorageView, over a matrix of file
+sizes, chunk sizes and concurrency levels, with either transport:
+
+    client  django's test client, in process. Upload bodies are built in
+            memory: cells of files larger than --client-max are skipped.
+    server  HTTP to a threaded wsgiref server in the same process, upload
+            bodies sent chunk_size bytes at a time.
+
+chunk_size is DOWNLOAD_CHUNK_SIZE, and the size of the writes and reads of
+the server transport. Reported per cell and direction: throughput, p50/p99
+latency and DB queries per request, along with the peak RSS of the cell,
+which runs in its own process. Results are saved as JSON and can be
+compared with those of another commit:
+
+    python -m secure_storage.benchmarks.load --sizes 1K,1M,1G -o before.json
+    python -m secure_storage.benchmarks.load --sizes 1K,1M,1G \\
+        --compare before.json
+
+Without DJANGO_SETTINGS_MODULE, each cell runs in a throwaway project with
+its own MEDIA_ROOT and sqlite database. '''
+
+from __future__ import absolute_import
+
+import httplib
+import json
+import math
+import optparse
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+from . import setup_django
+
+
+MB = 1024 * 1024
+UNITS = {'K': 1024, 'M': MB, 'G': 1024 * MB}
+PASSPHRASE = 'x' * 32
+BOUNDARY = 'BoUnDaRyStRiNg'
+
+
+def parse_sizes(value):
+    ''' returns the sizes of a comma separated list such as 1K,64M,1G '''
+    sizes = []
+    for item in value.upper().split(','):
+        item = item.strip()
+        if item[-1:] in UNITS:
+            sizes.append(int(item[:-1]) * UNITS[item[-1]])
+        else:
+            sizes.append(int(item))
+    return sizes
+
+
+def format_size(size):
+    for unit in 'GMK':
+        if size >= UNITS[unit] and not size % UNITS[unit]:
+            return '%d%s' % (size // UNITS[unit], unit)
+    return str(size)
+
+
+def percentile(values, fraction):
+    ''' nearest-rank percentile of values '''
+    values = sorted(values)
+    return values[max(int(math.ceil(len(values) * fraction)) - 1, 0)]
+
+
+def multipart_envelope():
+    ''' returns what goes before and after the file content in the body of
+    an upload '''
+    lines = []
+    for name, value in (('passphrase', PASSPHRASE), ('expire_date', '3600')):
+        lines.extend([
+            '--' + BOUNDARY,
+            'Content-Disposition: form-data; name="%s"' % name,
+            '', value])
+    lines.extend([
+        '--' + BOUNDARY,
+        'Content-Disposition: form-data; name="file"; filename="data.bin"',
+        'Content-Type: application/octet-stream', '', ''])
+    return '\r\n'.join(lines), '\r\n--%s--\r\n' % BOUNDARY
+
+
+def iter_content(block, size):
+    ''' yields size bytes of file content, block after block '''
+    while size > 0:
+        chunk = block[:size] if size < len(block) else block
+        size -= len(chunk)
+        yield chunk
+
+
+def check(status, content):
+    if status != 200:
+        raise RuntimeError('HTTP %d: %s' % (status, content[:200]))
+
+
+class ClientTransport(object):
+    ''' requests through django's test client, one client per thread '''
+
+    def __init__(self, urls, block, size):
+        self.urls = urls
+        head, tail = multipart_envelope()
+        self.body = head + ''.join(iter_content(block, size)) + tail
+        self.local = threading.local()
+
+    def client(self):
+        from django.test import Client
+
+        if not hasattr(self.local, 'client'):
+            self.local.client = Client()
+        return self.local.client
+
+    def upload(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client().generic(
+                'POST', self.urls['upload'], self.body,
+                content_type='multipart/form-data; boundary=%s' % BOUNDARY)
+        check(response.status_code, response.content)
+        return json.loads(response.content)['file_id'], len(queries)
+
+    def download(self, file_id):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client().post(self.urls['download'], dict(
+                file_id=file_id, passphrase=PASSPHRASE))
+            if response.status_code != 200:
+                check(response.status_code, response.content)
+            size = sum(len(chunk) for chunk in response.streaming_content)
+        return size, len(queries)
+
+    def close(self):
+        pass
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadedWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class QueryCountingApplication(object):
+    ''' WSGI application reporting the queries run by each request in an
+    X-Queries header. Queries run while the content of a response is sent
+    are not counted: downloads run none. '''
+
+    def __init__(self, application):
+        self.application = application
+
+    def __call__(self, environ, start_response):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as queries:
+
+            def counting_start_response(status, headers, exc_info=None):
+                headers.append(('X-Queries', str(len(queries))))
+                return start_response(status, headers, exc_info)
+
+            return self.application(environ, counting_start_response)
+
+
+class ServerTransport(object):
+    ''' requests over HTTP to a wsgiref server running in a thread '''
+
+    def __init__(self, urls, block, size):
+        from django.core.wsgi import get_wsgi_application
+
+        self.urls = urls
+        self.block = block
+        self.size = size
+        self.server = ThreadedWSGIServer(
+            ('127.0.0.1', 0), QuietRequestHandler)
+        self.server.set_app(QueryCountingApplication(get_wsgi_application()))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def connect(self, url, content_type, length):
+        connection = httplib.HTTPConnection(*self.server.server_address)
+        connection.putrequest('POST', url)
+        connection.putheader('Content-Type', content_type)
+        connection.putheader('Content-Length', str(length))
+        connection.endheaders()
+        return connection
+
+    def upload(self):
+        head, tail = multipart_envelope()
+        connection = self.connect(
+            self.urls['upload'],
+            'multipart/form-data; boundary=%s' % BOUNDARY,
+            len(head) + self.size + len(tail))
+        try:
+            connection.send(head)
+            for chunk in iter_content(self.block, self.size):
+                connection.send(chunk)
+            connection.send(tail)
+            response = connection.getresponse()
+            content = response.read()
+        finally:
+            connection.close()
+        check(response.status, content)
+        return (json.loads(content)['file_id'],
+                int(response.getheader('X-Queries', 0)))
+
+    def download(self, file_id):
+        body = urllib.urlencode(dict(file_id=file_id, passphrase=PASSPHRASE))
+        connection = self.connect(
+            self.urls['download'], 'application/x-www-form-urlencoded',
+            len(body))
+        try:
+            connection.send(body)
+            response = connection.getresponse()
+            if response.status != 200:
+                check(response.status, response.read())
+            size = 0
+            while True:
+                chunk = response.read(len(self.block))
+                if not chunk:
+                    break
+                size += len(chunk)
+        finally:
+            connection.close()
+        return size, int(response.getheader('X-Queries', 0))
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+TRANSPORTS = {
+    'client': ClientTransport,
+    'server': ServerTransport,
+}
+
+
+def run_phase(concurrency, jobs, func):
+    ''' runs func over jobs in concurrency threads, func returning the bytes
+    transferred and the queries run. Returns the phase measurements. '''
+    jobs = list(jobs)
+    lock = threading.Lock()
+    latencies = []
+    errors = []
+    totals = [0, 0]
+
+    def worker():
+        while True:
+            with lock:
+                if not jobs or errors:
+                    return
+                job = jobs.pop()
+            started = time.time()
+            try:
+                nbytes, queries = func(job)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+                return
+            elapsed = time.time() - started
+            with lock:
+                latencies.append(elapsed)
+                totals[0] += nbytes
+                totals[1] += queries
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    if errors:
+        raise errors[0]
+    return dict(
+        mb_per_s=totals[0] / elapsed / MB,
+        requests_per_s=len(latencies) / elapsed,
+        p50_ms=percentile(latencies, 0.5) * 1000,
+        p99_ms=percentile(latencies, 0.99) * 1000,
+        queries=float(totals[1]) / len(latencies))
+
+
+def run_cell(transport, size, chunk_size, concurrency, requests):
+    ''' runs one cell of the matrix in this process, returns its
+    measurements '''
+    throwaway = setup_django(
+        SECRET_KEY='benchmark', ALLOWED_HOSTS=['*'], MIDDLEWARE_CLASSES=[],
+        ROOT_URLCONF=__package__.rsplit('.', 1)[0] + '.urls',
+        DATABASES={'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(tempfile.mkdtemp(), 'db.sqlite3')}})
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.core.urlresolvers import reverse
+    from .. import app_settings
+
+    if throwaway:
+        call_command('migrate', interactive=False, verbosity=0)
+    if not os.path.isdir(app_settings.UPLOAD_DIR):
+        os.makedirs(app_settings.UPLOAD_DIR)
+    app_settings.DOWNLOAD_CHUNK_SIZE = chunk_size
+    urls = dict(upload=reverse('secure-storage-upload'),
+                download=reverse('secure-storage-download'))
+
+    block = os.urandom(max(min(chunk_size, size), 1))
+    client = TRANSPORTS[transport](urls, block, size)
+    file_ids = []
+
+    def upload(i):
+        file_id, queries = client.upload()
+        file_ids.append(file_id)
+        return size, queries
+
+    try:
+        uploads = run_phase(concurrency, range(requests), upload)
+        downloads = run_phase(concurrency, file_ids, client.download)
+    finally:
+        client.close()
+        if throwaway:
+            shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+            shutil.rmtree(os.path.dirname(
+                settings.DATABASES['default']['NAME']), ignore_errors=True)
+    return dict(
+        transport=transport, size=size, chunk_size=chunk_size,
+        concurrency=concurrency, requests=requests,
+        upload=uploads, download=downloads,
+        peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def cell_key(cell):
+    return (cell['transport'], cell['size'], cell['chunk_size'],
+            cell['concurrency'])
+
+
+def describe(cell):
+    return '%-6s %5s %5s x%-3d' % (
+        cell['transport'], format_size(cell['size']),
+        format_size(cell['chunk_size']), cell['concurrency'])
+
+
+def environment():
+    ''' returns what the results depend on besides the matrix '''
+    import django
+
+    setup_django()
+    from .. import app_settings
+
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(
+        commit=commit, python=platform.python_version(),
+        django=django.get_version(), settings=dict(
+            (name, getattr(app_settings, name)) for name in (
+                'FILE_FORMAT', 'SEGMENT_SIZE', 'CRYPTO_THREADS',
+                'CIPHER_BACKEND', 'COMPRESSION', 'METADATA_STORAGE',
+                'DOWNLOAD_PIPELINE_DEPTH')))
+
+
+def compare(results, previous, threshold):
+    ''' prints the changes from previous results, returns whether any
+    throughput or p99 latency got worse by more than threshold percent '''
+    before = dict((cell_key(cell), cell) for cell in previous['cells'])
+    regressed = False
+    print('\nCompared with %s:' % (previous.get('commit') or 'previous run'))
+    for cell in results['cells']:
+        old = before.get(cell_key(cell))
+        if old is None:
+            continue
+        changes = []
+        for direction in ('upload', 'download'):
+            throughput = 100.0 * (
+                cell[direction]['mb_per_s'] /
+                old[direction]['mb_per_s'] - 1)
+            latency = 100.0 * (
+                cell[direction]['p99_ms'] / old[direction]['p99_ms'] - 1)
+            worse = throughput < -threshold or latency > threshold
+            regressed = regressed or worse
+            changes.append('%s %+6.1f%% MB/s %+6.1f%% p99%s' % (
+                direction, throughput, latency, ' !' if worse else ''))
+        print('%s  %s' % (describe(cell), '  '.join(changes)))
+    return regressed
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--sizes', default='1K,1M,64M',
+                      help='file sizes, up to 1G or more')
+    parser.add_option('--chunk-sizes', default='64K,1M')
+    parser.add_option('--concurrency', default='1,8',
+                      help='concurrent requests')
+    parser.add_option('--transports', default='client,server')
+    parser.add_option('--requests', type='int', default=0,
+                      help='files per cell (default: up to 100, at most '
+                           '256 MB worth, at least one per thread)')
+    parser.add_option('--client-max', default='256M',
+                      help='largest file for the test client')
+    parser.add_option('-o', '--output', help='file to save results to')
+    parser.add_option('--compare', help='results of a previous run')
+    parser.add_option('--threshold', type='float', default=10,
+                      help='percent change reported as a regression')
+    parser.add_option('--cell', help='run a single cell, print JSON')
+    options, args = parser.parse_args()
+
+    if options.cell:
+        print(json.dumps(run_cell(**json.loads(options.cell))))
+        return
+
+    client_max = parse_sizes(options.client_max)[0]
+    results = environment()
+    results['cells'] = []
+    for transport in options.transports.split(','):
+        for size in parse_sizes(options.sizes):
+            for chunk_size in parse_sizes(options.chunk_sizes):
+                for concurrency in map(int, options.concurrency.split(',')):
+                    cell = dict(
+                        transport=transport, size=size,
+                        chunk_size=chunk_size, concurrency=concurrency,
+                        requests=options.requests or max(
+                            min(100, 256 * MB // max(size, 1)),
+                            concurrency))
+                    if transport == 'client' and size > client_max:
+                        print('%s  skipped' % describe(cell))
+                        continue
+                    output = subprocess.check_output([
+                        sys.executable, '-m', __package__ + '.load',
+                        '--cell', json.dumps(cell)])
+                    cell = json.loads(output.splitlines()[-1])
+                    results['cells'].append(cell)
+                    print('%s  %s  RSS %7d KB' % (describe(cell), '  '.join(
+                        '%s %8.1f MB/s p50 %8.1f p99 %8.1f ms %4.1f q' % (
+                            direction, cell[direction]['mb_per_s'],
+                            cell[direction]['p50_ms'],
+                            cell[direction]['p99_ms'],
+                            cell[direction]['queries'])
+                        for direction in ('upload', 'download')),
+                        cell['peak_rss_kb']))
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as previous:
+            if compare(results, json.load(previous), options.threshold):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
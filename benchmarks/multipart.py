@@ -0,0 +1,95 @@
+''' Multipart parsing benchmark: django's LazyStream/ChunkIter/Parser with
+16-byte realignment (the former IntelligentUploadHandler path) against
+MultiPartScanner. Only parsing is measured, not encryption. '''
+
+from __future__ import absolute_import
+
+import optparse
+import os
+import time
+from StringIO import StringIO
+
+from django.http.multipartparser import (
+    LazyStream, ChunkIter, Parser, FILE)
+
+from . import setup_django
+
+
+MB = 1024 * 1024
+BOUNDARY = 'BoUnDaRyStRiNg'
+
+
+def build_body(size):
+    ''' returns a multipart body with two fields and a size-bytes file '''
+    lines = []
+    for name, value in (('passphrase', 'x' * 32), ('expire_date', '3600')):
+        lines.extend([
+            '--' + BOUNDARY,
+            'Content-Disposition: form-data; name="%s"' % name,
+            '', value])
+    lines.extend([
+        '--' + BOUNDARY,
+        'Content-Disposition: form-data; name="file"; filename="data.bin"',
+        'Content-Type: application/octet-stream',
+        '', os.urandom(size),
+        '--' + BOUNDARY + '--', ''])
+    return '\r\n'.join(lines)
+
+
+def django_parser(body, chunk_size):
+    stream = LazyStream(ChunkIter(StringIO(body), chunk_size))
+    total = 0
+    for item_type, meta_data, field_stream in Parser(stream, BOUNDARY):
+        if item_type != FILE:
+            field_stream.read()
+            continue
+        for chunk in field_stream:
+            over_bytes = len(chunk) % 16
+            if over_bytes:
+                chunk += field_stream.read(16 - over_bytes)
+            total += len(chunk)
+    return total
+
+
+def scanner(body, chunk_size):
+    # Imports app_settings, which needs the settings
+    from ..multipart import MultiPartScanner
+    total = 0
+    for item_type, meta_data, part in MultiPartScanner(
+            StringIO(body), BOUNDARY, read_size=chunk_size):
+        if item_type != FILE:
+            part.read()
+            continue
+        for chunk in part:
+            total += len(chunk)
+    return total
+
+
+def run(size, chunk_size, repeat):
+    body = build_body(size)
+    for name, parse in (('django Parser', django_parser),
+                        ('MultiPartScanner', scanner)):
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            total = parse(body, chunk_size)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        assert total == size, (name, total)
+        print('%-18s %6d KB reads  %8.1f MB/s' % (
+            name, chunk_size // 1024, size / best / MB))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--size', type='int', default=100,
+                      help='file size in MB')
+    parser.add_option('--repeat', type='int', default=3)
+    options, args = parser.parse_args()
+    setup_django()
+    for chunk_size in (64 * 1024, 256 * 1024, MB):
+        run(options.size * MB, chunk_size, options.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+''' Upload write path benchmark: throughput and peak memory of encrypting
+and writing a file fed in multipart-sized chunks.
+
+Modes:
+    legacy     per-chunk padding, cipher.encrypt() and write (former path)
+    cbc        CBCWriter (legacy format, carry buffer, output= encryption)
+    segmented  SegmentWriter
+
+Each mode runs in its own process so that peak RSS is measured in
+isolation. '''
+
+from __future__ import absolute_import
+
+import json
+import optparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from . import setup_django
+
+
+MB = 1024 * 1024
+
+
+def legacy_writer(file_, passphrase):
+    from ..encryption import get_cipher_and_iv, padding
+
+    cipher = get_cipher_and_iv(passphrase)[0]
+
+    class Writer(object):
+        def write(self, data):
+            file_.write(cipher.encrypt(padding(data.tobytes())))
+
+        def close(self):
+            pass
+    return Writer()
+
+
+def new_writer(mode, file_, passphrase):
+    from ..encryption import get_cipher_and_iv, get_key
+    from ..segments import SegmentWriter
+    from ..storage import CBCWriter
+
+    if mode == 'cbc':
+        return CBCWriter(file_, get_cipher_and_iv(passphrase)[0])
+    return SegmentWriter(file_, get_key(passphrase))
+
+
+def run(mode, size, chunk_size):
+    ''' runs one mode in this process, returns its measurements '''
+    setup_django()
+    import io
+
+    source = memoryview(os.urandom(chunk_size))
+    passphrase = 'x' * 32
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        with io.open(path, 'wb') as file_:
+            if mode == 'legacy':
+                writer = legacy_writer(file_, passphrase)
+            else:
+                writer = new_writer(mode, file_, passphrase)
+            start = time.time()
+            for i in range(size // chunk_size):
+                writer.write(source)
+            writer.close()
+            elapsed = time.time() - start
+    finally:
+        os.unlink(path)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return dict(
+        mode=mode, size=size, chunk_size=chunk_size,
+        mb_per_s=size / elapsed / MB,
+        peak_rss_kb=rss_after, rss_growth_kb=rss_after - rss_before)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--size', type='int', default=100,
+                      help='file size in MB')
+    parser.add_option('--chunk-size', type='int', default=256,
+                      help='upload chunk size in KB')
+    parser.add_option('--mode', help='run a single mode, print JSON')
+    options, args = parser.parse_args()
+    size, chunk_size = options.size * MB, options.chunk_size * 1024
+
+    if options.mode:
+        print(json.dumps(run(options.mode, size, chunk_size)))
+        return
+
+    for mode in ('legacy', 'cbc', 'segmented'):
+        output = subprocess.check_output([
+            sys.executable, '-m', __package__ + '.upload', '--mode', mode,
+            '--size', str(options.size),
+            '--chunk-size', str(options.chunk_size)])
+        result = json.loads(output.splitlines()[-1])
+        print('%-10s %8.1f MB/s  peak RSS %7d KB  (+%d KB)' % (
+            mode, result['mb_per_s'], result['peak_rss_kb'],
+            result['rss_growth_kb']))
+
+
+if __name__ == '__main__':
+    main()
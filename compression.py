@@ -0,0 +1,67 @@
+''' Stream compression of file contents, ahead of the cipher.
+
+New segmented files are compressed with app_settings.COMPRESSION ('zlib' or
+'zstd', the latter requiring the zstandard package) unless their content
+type is listed as incompressible. The compression of each file is recorded
+with its metadata; size remains the clear length. '''
+
+import zlib
+
+import app_settings as settings
+from .backends import as_bytes
+
+
+def choose_compression(content_type):
+    ''' returns the compression for a new file of content_type, or '' '''
+    content_type = (content_type or '').lower()
+    if not settings.COMPRESSION or any(
+            content_type.startswith(prefix)
+            for prefix in settings.INCOMPRESSIBLE_TYPES):
+        return ''
+    return settings.COMPRESSION
+
+
+class Compressor(object):
+    ''' compresses the data written through it '''
+
+    def __init__(self, compression):
+        if compression == 'zlib':
+            self.compressor = zlib.compressobj(settings.COMPRESSION_LEVEL)
+        elif compression == 'zstd':
+            import zstandard
+            self.compressor = zstandard.ZstdCompressor(
+                level=settings.COMPRESSION_LEVEL).compressobj()
+        else:
+            raise ValueError('Unknown compression %r' % compression)
+
+    def compress(self, data):
+        return self.compressor.compress(as_bytes(data))
+
+    def flush(self):
+        return self.compressor.flush()
+
+
+def decompress(compression, blocks, chunk_size):
+    ''' yields the decompressed data of blocks as memoryviews, of at most
+    chunk_size bytes for zlib '''
+    if compression == 'zlib':
+        decompressor = zlib.decompressobj()
+        for block in blocks:
+            data = as_bytes(block)
+            while data:
+                chunk = decompressor.decompress(data, chunk_size)
+                if chunk:
+                    yield memoryview(chunk)
+                data = decompressor.unconsumed_tail
+        chunk = decompressor.flush()
+        if chunk:
+            yield memoryview(chunk)
+    elif compression == 'zstd':
+        import zstandard
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        for block in blocks:
+            chunk = decompressor.decompress(as_bytes(block))
+            if chunk:
+                yield memoryview(chunk)
+    else:
+        raise ValueError('Unknown compression %r' % compression)
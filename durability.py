@@ -0,0 +1,122 @@
+''' How encrypted files are written out.
+
+Files are written through a WRITE_BUFFER_SIZE buffer, under a temporary
+name, and renamed into place once complete so that a partially written file
+is never served. New files are preallocated from their declared length
+(PREALLOCATE) to limit fragmentation. FSYNC selects when they are synced to
+disk: never (None), before being renamed into place ('close'), or also
+every FSYNC_INTERVAL bytes written ('periodic'). '''
+
+import ctypes
+import ctypes.util
+import errno
+import io
+import os
+from os.path import dirname
+
+import app_settings as settings
+
+
+# Suffix of the files being written
+TEMP_SUFFIX = '.tmp'
+
+
+class PeriodicSync(object):
+    ''' syncs a buffered file to disk every FSYNC_INTERVAL bytes written '''
+
+    unsynced = 0
+
+    def write(self, data):
+        written = super(PeriodicSync, self).write(data)
+        self.unsynced += len(data)
+        if self.unsynced >= settings.FSYNC_INTERVAL:
+            self.flush()
+            os.fsync(self.fileno())
+            self.unsynced = 0
+        return written
+
+
+class PeriodicSyncWriter(PeriodicSync, io.BufferedWriter):
+    pass
+
+
+class PeriodicSyncRandom(PeriodicSync, io.BufferedRandom):
+    pass
+
+
+def open_for_writing(path, mode='wb'):
+    ''' opens path to write to, 'wb' or 'r+b', buffered by WRITE_BUFFER_SIZE
+    bytes '''
+    raw = io.FileIO(path, mode.replace('b', ''))
+    buffer_size = settings.WRITE_BUFFER_SIZE or io.DEFAULT_BUFFER_SIZE
+    periodic = settings.FSYNC == 'periodic'
+    if mode == 'wb':
+        cls = PeriodicSyncWriter if periodic else io.BufferedWriter
+    else:
+        cls = PeriodicSyncRandom if periodic else io.BufferedRandom
+    return cls(raw, buffer_size)
+
+
+def _libc_fallocate():
+    ''' returns posix_fallocate from the C library, as os.posix_fallocate
+    (Python 3.3+), or None '''
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+    if hasattr(libc, 'posix_fallocate64'):
+        func = libc.posix_fallocate64
+        func.argtypes = (ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+    elif hasattr(libc, 'posix_fallocate'):
+        func = libc.posix_fallocate
+        func.argtypes = (ctypes.c_int, ctypes.c_long, ctypes.c_long)
+    else:
+        return None
+
+    def posix_fallocate(fd, offset, length):
+        # Returns the error number rather than setting errno
+        error = func(fd, offset, length)
+        if error:
+            raise OSError(error, os.strerror(error))
+    return posix_fallocate
+
+
+_fallocate = getattr(os, 'posix_fallocate', None)
+if _fallocate is None:
+    _fallocate = _libc_fallocate()
+
+
+def preallocate(file_, size):
+    ''' preallocates size bytes for file_, which then has to be truncated
+    once written. Returns whether it did. Raises IOError if there is not
+    enough space left. '''
+    if not settings.PREALLOCATE or _fallocate is None or size <= 0:
+        return False
+    file_.flush()
+    try:
+        _fallocate(file_.fileno(), 0, size)
+    except (OSError, IOError) as e:
+        if e.errno == errno.ENOSPC:
+            raise IOError(e.errno, e.strerror)
+        # Not supported by the file system
+        return False
+    return True
+
+
+def sync_file(file_):
+    ''' syncs file_ to disk, as the FSYNC policy wants it before close '''
+    if settings.FSYNC:
+        file_.flush()
+        os.fsync(file_.fileno())
+
+
+def move_into_place(temp_path, path):
+    ''' renames a complete file to its final name, in a single step '''
+    os.rename(temp_path, path)
+    if settings.FSYNC:
+        # Makes the rename itself durable
+        fd = os.open(dirname(path), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
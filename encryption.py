@@ -1,32 +1,154 @@
 
-from Crypto.Cipher import AES
-from Crypto.Random.random import StrongRandom
 import hashlib
+import hmac
+import struct
+import time
+from collections import OrderedDict
+from threading import Lock
+
+import app_settings as settings
+from .backends import load_backend
+from .entropy import random_bytes
+
+
+BLOCK_SIZE = 16
+
+# AES-GCM nonce and authentication tag sizes, in bytes.
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+_backend = None
+
+
+def get_backend():
+    ''' returns the AES engine selected by app_settings.CIPHER_BACKEND '''
+    global _backend
+    if _backend is None:
+        _backend = load_backend(settings.CIPHER_BACKEND)
+    return _backend
 
 
 def generate_random(nbytes):
     ''' returns nbytes-long random string '''
-    return ''.join(chr(StrongRandom().randint(0, 0xFF)) for i in range(nbytes))
+    return random_bytes(nbytes)
 
 
 def new_cbc(key, salt=None):
     ''' initializes a AES cipher block chaining. '''
     if not salt:
         salt = generate_random(16)
-    cipher = AES.new(key, AES.MODE_CBC, salt)
+    cipher = get_backend().cbc(key, salt)
     return cipher, salt
 
 
-def get_key(passphrase):
-    ''' returns a 256-bits key based on passphrase '''
-    h = hashlib.new('sha256')
-    h.update(passphrase)
-    return h.hexdigest()[:32]
+def current_kdf():
+    ''' returns the KDF spec recorded with new files '''
+    if settings.KDF == 'pbkdf2_sha256':
+        return 'pbkdf2_sha256$%d' % settings.KDF_ITERATIONS
+    return ''
+
+
+def derive_key(passphrase, salt, kdf):
+    ''' derives a 256-bits key from passphrase. kdf is '' for the legacy
+    unsalted sha256, or 'pbkdf2_sha256$<iterations>'. '''
+    if isinstance(passphrase, unicode):
+        passphrase = passphrase.encode('utf-8')
+    if not kdf:
+        h = hashlib.new('sha256')
+        h.update(passphrase)
+        return h.hexdigest()[:32]
+    algorithm, iterations = kdf.split('$')
+    if algorithm != 'pbkdf2_sha256':
+        raise ValueError('Unknown KDF %r' % kdf)
+    return hashlib.pbkdf2_hmac('sha256', passphrase, salt, int(iterations))
+
+
+def offload_derive_key(passphrase, salt, kdf):
+    ''' derive_key(), out of the event loop under gevent: PBKDF2 would block
+    every other transfer while it runs '''
+    if not kdf:
+        return derive_key(passphrase, salt, kdf)
+    # segments imports this module
+    from .segments import offload
+    return offload(derive_key, passphrase, salt, kdf)
+
+
+class KeyCache(object):
+    ''' Bounded LRU cache of derived keys with a time to live, so that one
+    upload or download pays for the KDF once. Entries are indexed by an HMAC
+    of the passphrase under a per-process secret, never by the passphrase
+    itself. Evicted keys are overwritten (on a best effort basis: callers
+    get copies). '''
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.secret = random_bytes(32)
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def _index(self, passphrase, salt, kdf):
+        if isinstance(passphrase, unicode):
+            passphrase = passphrase.encode('utf-8')
+        mac = hmac.new(self.secret, digestmod=hashlib.sha256)
+        for value in (kdf, salt or '', passphrase):
+            mac.update('%d:%s' % (len(value), value))
+        return mac.digest()
+
+    def _evict(self, index):
+        expires, key = self.entries.pop(index)
+        key[:] = '\x00' * len(key)
+
+    def get(self, passphrase, salt, kdf):
+        if not self.size:
+            return offload_derive_key(passphrase, salt, kdf)
+        index = self._index(passphrase, salt, kdf)
+        with self.lock:
+            entry = self.entries.get(index)
+            if entry and entry[0] > time.time():
+                # Most recently used entries go last
+                del self.entries[index]
+                self.entries[index] = entry
+                return bytes(entry[1])
+        key = offload_derive_key(passphrase, salt, kdf)
+        with self.lock:
+            if index in self.entries:
+                self._evict(index)
+            self.entries[index] = (time.time() + self.ttl, bytearray(key))
+            while len(self.entries) > self.size:
+                self._evict(next(iter(self.entries)))
+        return key
+
+    def clear(self):
+        with self.lock:
+            for index in list(self.entries):
+                self._evict(index)
+
 
+_key_cache = KeyCache(settings.KEY_CACHE_SIZE, settings.KEY_CACHE_TTL)
 
-def get_cipher_and_iv(passphrase, salt=None):
+
+def get_key(passphrase, salt=None, kdf=''):
+    ''' returns a 256-bits key based on passphrase, see derive_key() '''
+    return _key_cache.get(passphrase, salt, kdf)
+
+
+def get_cipher_and_iv(passphrase, salt=None, kdf=''):
     ''' get cipher for a given passphrase and salt.  '''
-    return new_cbc(get_key(passphrase), salt)
+    if not salt:
+        salt = generate_random(16)
+    return new_cbc(get_key(passphrase, salt, kdf), salt)
+
+
+def key_check_value(key, iv):
+    ''' returns a value, stored with a file, that proves knowledge of its
+    key without revealing it '''
+    return hmac.new(key, 'key-check' + iv, hashlib.sha256).hexdigest()
+
+
+def verify_key(key, iv, value):
+    ''' constant time check of key against a stored key check value '''
+    return hmac.compare_digest(key_check_value(key, iv), str(value))
 
 
 def padding(buff):
@@ -47,3 +169,42 @@ def decrypt_string(buff, passphrase, iv):
     ''' function for quick and dirty string decryption '''
     cipher = get_cipher_and_iv(passphrase, iv)[0]
     return cipher.decrypt(buff).strip()
+
+
+def segment_aad(index, last):
+    ''' associated data binding a segment to its position in the file '''
+    return struct.pack('>QB', index, bool(last))
+
+
+def seal(key, data, aad):
+    ''' encrypts data with AES-GCM, returns nonce + ciphertext + tag '''
+    nonce = generate_random(NONCE_SIZE)
+    return nonce + get_backend().gcm_encrypt(key, nonce, data, aad)
+
+
+def unseal(key, blob, aad):
+    ''' decrypts what seal() returned, raises ValueError if it has been
+    tampered with (or the key is wrong) '''
+    return get_backend().gcm_decrypt(
+        key, blob[:NONCE_SIZE], blob[NONCE_SIZE:], aad)
+
+
+def encrypt_segment(key, index, data, last=False, output=None):
+    ''' encrypts one segment with AES-GCM, returns nonce + ciphertext + tag.
+    If given, output is a writable buffer of len(data) + NONCE_SIZE + TAG_SIZE
+    bytes the segment is encrypted into. '''
+    nonce = generate_random(NONCE_SIZE)
+    aad = segment_aad(index, last)
+    if output is None:
+        return nonce + get_backend().gcm_encrypt(key, nonce, data, aad)
+    output[:NONCE_SIZE] = nonce
+    get_backend().gcm_encrypt(key, nonce, data, aad, output[NONCE_SIZE:])
+    return output
+
+
+def decrypt_segment(key, index, blob, last=False, output=None):
+    ''' decrypts one segment, raises ValueError if it has been tampered with.
+    If given, the plaintext is decrypted into the output buffer. '''
+    return get_backend().gcm_decrypt(
+        key, blob[:NONCE_SIZE], blob[NONCE_SIZE:], segment_aad(index, last),
+        output)
@@ -0,0 +1,49 @@
+''' Per-process buffered entropy for IVs, nonces, salts and file ids.
+
+Random bytes are drawn from os.urandom in bulk and handed out from a pool,
+each byte only once. The pool is discarded when the process id changes, so
+that a worker forked from a pre-fork server never hands out bytes its
+parent (or a sibling) also holds. '''
+
+import os
+from threading import Lock
+from uuid import UUID
+
+import app_settings as settings
+
+
+class EntropyPool(object):
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = Lock()
+        self.buffer = ''
+        self.position = 0
+        self.pid = None
+
+    def read(self, nbytes):
+        ''' returns nbytes random bytes '''
+        if nbytes > self.size:
+            return os.urandom(nbytes)
+        with self.lock:
+            if self.pid != os.getpid() or \
+                    self.position + nbytes > len(self.buffer):
+                self.buffer = os.urandom(self.size)
+                self.position = 0
+                self.pid = os.getpid()
+            data = self.buffer[self.position:self.position + nbytes]
+            self.position += nbytes
+            return data
+
+
+_pool = EntropyPool(settings.ENTROPY_POOL_SIZE)
+
+
+def random_bytes(nbytes):
+    ''' returns nbytes-long random string '''
+    return _pool.read(nbytes)
+
+
+def new_file_id():
+    ''' returns a random (uuid4) hexadecimal file id '''
+    return UUID(bytes=random_bytes(16), version=4).hex
@@ -1,6 +1,28 @@
 from django import forms
 from django.core.exceptions import ValidationError
-from app_settings import EXPIRATION_CHOICES
+from app_settings import EXPIRATION_CHOICES, RESUMABLE_UPLOAD_SIZE_LIMIT
+import app_settings as settings
+
+
+class MultipleValueField(forms.Field):
+    ''' a field given any number of times, cleaned to a list '''
+
+    widget = forms.MultipleHiddenInput
+
+    def __init__(self, max_length=None, max_count=None, *args, **kwargs):
+        self.max_length = max_length
+        self.max_count = max_count
+        super(MultipleValueField, self).__init__(*args, **kwargs)
+
+    def to_python(self, value):
+        return [forms.CharField(max_length=self.max_length).clean(item)
+                for item in value or []]
+
+    def validate(self, value):
+        super(MultipleValueField, self).validate(value)
+        if self.max_count and len(value) > self.max_count:
+            raise ValidationError(
+                'At most %d values are allowed.' % self.max_count)
 
 
 class DownloadFileForm(forms.Form):
@@ -52,3 +74,58 @@ class UploadFileForm(forms.Form):
             raise ValidationError('Passphrase must be at least 20 chars long.')
         return passphrase
 
+
+
+class UploadSessionForm(UploadFileForm):
+
+    file = None
+
+    filename = forms.CharField(
+        max_length=255,
+        required=True,
+    )
+    content_type = forms.CharField(
+        max_length=100,
+        required=False,
+    )
+    length = forms.IntegerField(
+        min_value=0,
+        max_value=RESUMABLE_UPLOAD_SIZE_LIMIT,
+        required=True,
+    )
+    part_size = forms.IntegerField(
+        min_value=0,
+        required=False,
+    )
+
+    def clean_part_size(self):
+
+        part_size = self.cleaned_data['part_size'] or 0
+        if part_size % settings.SEGMENT_SIZE:
+            raise ValidationError(
+                'Part size must be a multiple of %d.' % settings.SEGMENT_SIZE)
+        return part_size
+
+
+class BatchDownloadForm(forms.Form):
+    ''' file_id and passphrase are given once per file, in the same order '''
+
+    file_id = MultipleValueField(
+        max_length=32,
+        max_count=settings.BATCH_DOWNLOAD_LIMIT,
+        required=True,
+    )
+
+    passphrase = MultipleValueField(
+        max_length=100,
+        required=True,
+    )
+
+    def clean(self):
+
+        cleaned_data = super(BatchDownloadForm, self).clean()
+        if len(cleaned_data.get('file_id', ())) != \
+                len(cleaned_data.get('passphrase', ())):
+            raise ValidationError(
+                'One passphrase is required per file.')
+        return cleaned_data
@@ -1,15 +1,114 @@
-from os import listdir, unlink
-from os.path import join
+import time
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+from os import stat, unlink
+
 from django.core.management.base import BaseCommand, CommandError
-from secure_storage.models import EncryptedUploadedFileMetaData
-from secure_storage import app_settings 
+from django.db.models import Q
+from django.utils.timezone import now
+from secure_storage.models import EncryptedUploadedFileMetaData, UploadSession
+from secure_storage.storage import EncryptedFileSystemStorage
+
+
+def iter_batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
 
 class Command(BaseCommand):
     help = 'Removes all the expired files'
 
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--batch-size', dest='batch_size', type='int', default=900,
+            help='Files checked against the database per query (SQLite '
+                 'takes at most 999)'),
+        make_option(
+            '--workers', dest='workers', type='int', default=8,
+            help='Threads unlinking files'),
+        make_option(
+            '--min-age', dest='min_age', type='int', default=3600,
+            help='Seconds before a file without metadata is removed, '
+                 'so that uploads in progress are left alone'),
+        make_option(
+            '--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only report what would be removed'),
+    )
+
     def handle(self, *args, **options):
 
-        for f in listdir(app_settings.UPLOAD_DIR):
-            if not EncryptedUploadedFileMetaData.objects.filter(file_id=f).exists():
-                self.stdout.write('Removing file %s' % f)
-                unlink(join(app_settings.UPLOAD_DIR,f))
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+        start = time.time()
+        self.dry_run = options['dry_run']
+        self.min_age = options['min_age']
+        self.verbosity = int(options.get('verbosity', 1))
+        cutoff = now()
+
+        expired = EncryptedUploadedFileMetaData.objects.filter(
+            expire_date__lt=cutoff)
+        expired_rows = expired.count()
+        if not self.dry_run:
+            # Single bulk DELETE: the model has no relations nor signals.
+            # The files of these rows go with the other orphans below.
+            expired.delete()
+        live = EncryptedUploadedFileMetaData.objects.filter(
+            Q(expire_date__isnull=True) | Q(expire_date__gte=cutoff))
+        # Files of unfinished resumable uploads are kept until their
+        # session expires.
+        sessions = UploadSession.objects.filter(expire_date__lt=cutoff)
+        expired_rows += sessions.count()
+        if not self.dry_run:
+            sessions.delete()
+        uploading = UploadSession.objects.filter(expire_date__gte=cutoff)
+
+        scanned = removed = 0
+        pool = ThreadPool(options['workers'])
+        try:
+            for batch in iter_batches(
+                    EncryptedFileSystemStorage().iter_files(),
+                    options['batch_size']):
+                scanned += len(batch)
+                # Files being written (.tmp) and the parts of multi-part
+                # uploads are named after their file, but only kept while
+                # it is being uploaded: a part written after its upload
+                # was assembled is left behind.
+                names = [name.split('.', 1)[0] for name, path in batch]
+                known = set(live.filter(
+                    file_id__in=names).values_list('file_id', flat=True))
+                uploads = set(uploading.filter(
+                    file_id__in=names).values_list('file_id', flat=True))
+                orphans = [
+                    path for name, path in batch
+                    if name not in known and
+                    name.split('.', 1)[0] not in uploads]
+                removed += sum(pool.map(self.remove, orphans))
+        finally:
+            pool.close()
+            pool.join()
+
+        self.stdout.write(
+            '%s %d expired metadata rows, %s %d of %d files in %.1fs' % (
+                'Would delete' if self.dry_run else 'Deleted', expired_rows,
+                'would remove' if self.dry_run else 'removed', removed,
+                scanned, time.time() - start))
+
+    def remove(self, path):
+        ''' removes a file without metadata, returns 1 if it was removed '''
+        try:
+            if time.time() - stat(path).st_mtime < self.min_age:
+                return 0
+            if not self.dry_run:
+                unlink(path)
+        except OSError:
+            # Removed meanwhile
+            return 0
+        if self.verbosity > 1:
+            self.stdout.write('Removing file %s' % path)
+        return 1
@@ -0,0 +1,55 @@
+import time
+from optparse import make_option
+from os import rename
+
+from django.core.management.base import BaseCommand
+from secure_storage.storage import EncryptedFileSystemStorage
+
+
+class Command(BaseCommand):
+    help = 'Moves stored files to the configured sharded layout'
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--limit', dest='limit', type='int', default=0,
+            help='Stop after moving this many files (0: no limit)'),
+        make_option(
+            '--batch-size', dest='batch_size', type='int', default=1000,
+            help='Files moved between pauses'),
+        make_option(
+            '--pause', dest='pause', type='float', default=0,
+            help='Seconds to sleep between batches'),
+        make_option(
+            '--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only report what would be moved'),
+    )
+
+    def handle(self, *args, **options):
+
+        start = time.time()
+        storage = EncryptedFileSystemStorage()
+        scanned = moved = 0
+
+        # Downloads look files up at their sharded path first, then at the
+        # flat one, so they keep working while files are being moved.
+        for name, path in storage.iter_files():
+            scanned += 1
+            target = storage.path(name)
+            if path == target:
+                continue
+            if not options['dry_run']:
+                storage.make_shard(name)
+                try:
+                    rename(path, target)
+                except OSError:
+                    # Removed meanwhile
+                    continue
+            moved += 1
+            if moved == options['limit']:
+                break
+            if options['pause'] and moved % options['batch_size'] == 0:
+                time.sleep(options['pause'])
+
+        self.stdout.write('%s %d of %d files in %.1fs' % (
+            'Would move' if options['dry_run'] else 'Moved', moved, scanned,
+            time.time() - start))
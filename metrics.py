@@ -0,0 +1,229 @@
+''' Stage timings and byte counts of uploads and downloads.
+
+A Transfer is started per upload or download (for a METRICS_SAMPLE_RATE
+fraction of them) and handed to the objects taking part in it, which add
+the time spent and bytes handled in each stage: read, parse, compress,
+encrypt, write, metadata, decrypt, decompress, send. Unsampled transfers
+are NULL, which is false: hot paths only read the clock when the transfer
+is true. Finished transfers are sent to the METRICS_SINK, logged if
+METRICS_LOG, and signaled with transfer_finished. '''
+
+import logging
+import random
+import socket
+from threading import Lock
+from timeit import default_timer as clock
+
+from django.dispatch import Signal
+
+import app_settings as settings
+
+
+transfer_finished = Signal(providing_args=['transfer'])
+
+logger = logging.getLogger('secure_storage.metrics')
+
+
+class NullTransfer(object):
+    ''' a transfer which is not measured '''
+
+    def __nonzero__(self):
+        return False
+
+    def add(self, stage, seconds, nbytes=0):
+        pass
+
+    def seconds(self, stage):
+        return 0
+
+    def finish(self):
+        pass
+
+    def wrap(self, iterable):
+        return iterable
+
+
+NULL = NullTransfer()
+_END = object()
+
+
+class Transfer(object):
+    ''' timings and byte counts of one upload or download, by stage '''
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.stages = {}
+        self.started = clock()
+        self.duration = None
+
+    def add(self, stage, seconds, nbytes=0):
+        entry = self.stages.get(stage)
+        if entry is None:
+            entry = self.stages[stage] = [0, 0.0, 0]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] += nbytes
+
+    def seconds(self, stage):
+        return self.stages.get(stage, (0, 0))[1]
+
+    def finish(self):
+        if self.duration is not None:
+            return
+        self.duration = clock() - self.started
+        sink = get_sink()
+        if sink:
+            sink.record(self)
+        if settings.METRICS_LOG:
+            logger.info('%s', self)
+        transfer_finished.send(sender=Transfer, transfer=self)
+
+    def wrap(self, iterable):
+        ''' yields from iterable, the response content of a download, timing
+        what the server does with each item as the send stage. The transfer
+        is finished with the response, which closes iterable. '''
+        try:
+            for item in iterable:
+                started = clock()
+                yield item
+                self.add('send', clock() - started, len(item))
+        finally:
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                close()
+            self.finish()
+
+    def __str__(self):
+        return '%s in %.3fs: %s' % (self.kind, self.duration or 0, ', '.join(
+            '%s %.3fs %dB' % (stage, seconds, nbytes)
+            for stage, (count, seconds, nbytes) in sorted(
+                self.stages.items())))
+
+
+def start_transfer(kind):
+    ''' returns a new Transfer, or NULL if it is not sampled '''
+    rate = settings.METRICS_SAMPLE_RATE
+    if not rate or not (settings.METRICS_SINK or settings.METRICS_LOG or
+                        transfer_finished.has_listeners(Transfer)):
+        return NULL
+    if rate < 1 and random.random() >= rate:
+        return NULL
+    return Transfer(kind)
+
+
+def timed(iterable, transfer, stage, exclude=()):
+    ''' yields from iterable, timing how long each item takes to come as
+    stage, less the time spent meanwhile in the stages of exclude '''
+    iterator = iter(iterable)
+    while True:
+        started = clock()
+        excluded = sum(transfer.seconds(other) for other in exclude)
+        item = next(iterator, _END)
+        transfer.add(stage, clock() - started - (
+            sum(transfer.seconds(other) for other in exclude) - excluded))
+        if item is _END:
+            return
+        yield item
+
+
+class PrometheusSink(object):
+    ''' Accumulates transfers in process, render() returns them in the
+    Prometheus text format (see MetricsView). '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.transfers = {}
+        self.stages = {}
+
+    def record(self, transfer):
+        with self.lock:
+            entry = self.transfers.setdefault(transfer.kind, [0, 0.0])
+            entry[0] += 1
+            entry[1] += transfer.duration
+            for stage, (count, seconds, nbytes) in transfer.stages.items():
+                entry = self.stages.setdefault(
+                    (transfer.kind, stage), [0, 0.0, 0])
+                entry[0] += count
+                entry[1] += seconds
+                entry[2] += nbytes
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, help_, values in (
+                    ('secure_storage_transfers_total',
+                     'Transfers measured', [
+                         ('kind="%s"' % kind, value[0])
+                         for kind, value in sorted(self.transfers.items())]),
+                    ('secure_storage_transfer_seconds_total',
+                     'Time spent in transfers', [
+                         ('kind="%s"' % kind, value[1])
+                         for kind, value in sorted(self.transfers.items())]),
+                    ('secure_storage_stage_seconds_total',
+                     'Time spent per transfer stage', [
+                         ('kind="%s",stage="%s"' % key, value[1])
+                         for key, value in sorted(self.stages.items())]),
+                    ('secure_storage_stage_bytes_total',
+                     'Bytes handled per transfer stage', [
+                         ('kind="%s",stage="%s"' % key, value[2])
+                         for key, value in sorted(self.stages.items())])):
+                lines.append('# HELP %s %s' % (name, help_))
+                lines.append('# TYPE %s counter' % name)
+                for labels, value in values:
+                    lines.append('%s{%s} %s' % (name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+class StatsdSink(object):
+    ''' Sends each transfer to statsd (METRICS_STATSD_ADDRESS) as timers and
+    byte counters, in one UDP datagram. '''
+
+    def __init__(self):
+        self.address = settings.METRICS_STATSD_ADDRESS
+        self.prefix = settings.METRICS_STATSD_PREFIX
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def record(self, transfer):
+        rate = settings.METRICS_SAMPLE_RATE
+        suffix = '|@%g' % rate if rate < 1 else ''
+        name = '%s.%s' % (self.prefix, transfer.kind)
+        lines = ['%s.seconds:%d|ms%s' % (
+            name, transfer.duration * 1000, suffix)]
+        for stage, (count, seconds, nbytes) in transfer.stages.items():
+            lines.append('%s.%s.seconds:%d|ms%s' % (
+                name, stage, seconds * 1000, suffix))
+            if nbytes:
+                lines.append('%s.%s.bytes:%d|c%s' % (
+                    name, stage, nbytes, suffix))
+        try:
+            self.socket.sendto('\n'.join(lines), self.address)
+        except socket.error:
+            # Metrics are not worth failing a transfer
+            pass
+
+
+SINKS = {
+    'prometheus': PrometheusSink,
+    'statsd': StatsdSink,
+}
+
+_sink = None
+_sink_name = None
+
+
+def get_sink():
+    ''' returns the sink selected by app_settings.METRICS_SINK, from its
+    SINKS name or the dotted path to a class with a record(transfer) method,
+    or None '''
+    global _sink, _sink_name
+    name = settings.METRICS_SINK
+    if name != _sink_name:
+        if not name:
+            _sink = None
+        elif name in SINKS:
+            _sink = SINKS[name]()
+        else:
+            from django.utils.module_loading import import_string
+            _sink = import_string(name)()
+        _sink_name = name
+    return _sink
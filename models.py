@@ -1,7 +1,63 @@
-import pickle
-from django.db import models
-from .encryption import get_cipher_and_iv, padding
+import fcntl
+import io
+import os
+import re
+import shutil
+from ast import literal_eval
+from base64 import b64decode, b64encode
+from datetime import timedelta
+from django.db import (
+    IntegrityError, connections, models, router, transaction)
+from django.dispatch import Signal
+from .encryption import (
+    get_cipher_and_iv, get_key, key_check_value, padding, verify_key)
 from django.utils.timezone import now
+from .durability import (
+    TEMP_SUFFIX, move_into_place, open_for_writing, sync_file)
+from .metrics import NULL, clock
+import app_settings as settings
+
+
+# Protocol 0 pickle of a string, as written by older versions
+PICKLED_STRING_RE = re.compile(r'^S(\'.*\'|".*")\np\d+\n\.$', re.DOTALL)
+
+# Sent when the metadata of a file is deleted by a claim
+file_claimed = Signal(providing_args=['file_id'])
+
+
+def get_cache():
+    ''' returns the cache metadata rows are kept in, if any '''
+    if settings.METADATA_CACHE:
+        from django.core.cache import caches
+        return caches[settings.METADATA_CACHE]
+    return None
+
+
+def timed_query(file_, func, *args, **kwargs):
+    ''' returns func(*args, **kwargs), timed as the metadata stage of the
+    transfer of file_ '''
+    metrics = getattr(file_, 'metrics', NULL)
+    if not metrics:
+        return func(*args, **kwargs)
+    started = clock()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        metrics.add('metadata', clock() - started)
+
+
+def encode_binary(value):
+    return b64encode(value)
+
+
+def decode_binary(value):
+    ''' decodes an iv or encrypted_name column, base64 or (for older rows)
+    pickled, without unpickling arbitrary data '''
+    value = str(value)
+    match = PICKLED_STRING_RE.match(value)
+    if match:
+        return literal_eval(match.group(1))
+    return b64decode(value)
 
 
 class EncryptedUploadedFileMetaData(models.Model):
@@ -15,8 +71,15 @@ class EncryptedUploadedFileMetaData(models.Model):
     # salt for AES cipher
     iv = models.CharField(max_length=50)
 
+    # Key derivation function spec, empty for legacy sha256 keys
+    kdf = models.CharField(max_length=50, blank=True, default='')
+
+    # Proves the passphrase before any decryption, empty for legacy files
+    key_check = models.CharField(max_length=64, blank=True, default='')
+
     # File Access Expiration date
-    expire_date = models.DateTimeField(auto_now=False, null=True, blank=True)
+    expire_date = models.DateTimeField(
+        auto_now=False, null=True, blank=True, db_index=True)
 
     # File access one time flag
     one_time = models.BooleanField(default=False)
@@ -24,63 +87,456 @@ class EncryptedUploadedFileMetaData(models.Model):
     # Clear file size
     size = models.IntegerField(default=0, null=True, blank=True)
 
+    # Compression of the file contents, see compression.py
+    compression = models.CharField(max_length=10, blank=True, default='')
+
     @classmethod
-    def save_(cls, file_):
-        ''' writes metadata for a given file '''
-        cipher = get_cipher_and_iv(file_.passphrase, file_.iv)[0]
+    def cache_key(cls, file_id):
+        return 'secure_storage:%s' % file_id
+
+    @classmethod
+    def get(cls, file_id):
+        ''' returns the metadata row of a file, from the cache if possible '''
+        from .storage import InexistentFile
+        cache = get_cache()
+        metadata = cache and cache.get(cls.cache_key(file_id))
+        if metadata is None:
+            try:
+                metadata = cls.objects.get(file_id=file_id)
+            except cls.DoesNotExist:
+                raise InexistentFile
+            if cache:
+                cache.set(cls.cache_key(file_id), metadata,
+                          settings.METADATA_CACHE_TTL)
+        return metadata
+
+    @classmethod
+    def get_many(cls, file_ids):
+        ''' returns {file_id: metadata row} for the files found, from the
+        cache if possible and with a single query for the others '''
+        cache = get_cache()
+        rows = {}
+        if cache:
+            for metadata in cache.get_many(
+                    [cls.cache_key(file_id) for file_id in file_ids]).values():
+                rows[metadata.file_id] = metadata
+        missing = set(file_ids) - set(rows)
+        if missing:
+            found = dict((metadata.file_id, metadata) for metadata in
+                         cls.objects.filter(file_id__in=missing))
+            rows.update(found)
+            if cache and found:
+                cache.set_many(dict(
+                    (cls.cache_key(file_id), metadata)
+                    for file_id, metadata in found.items()),
+                    settings.METADATA_CACHE_TTL)
+        return rows
 
+    @classmethod
+    def build(cls, file_):
+        ''' returns the (unsaved) metadata of a given file.
+        Files which keep their metadata in their header only get their expiry
+        and one-time state saved. '''
         metadata = cls()
         metadata.file_id = file_.name
+        metadata.one_time = file_.one_time
+        metadata.expire_date = file_.expire_date
 
-        for attr in ('size', 'one_time', 'iv', 'expire_date'):
-            setattr(metadata, attr, getattr(file_, attr, None))
-        # Encrypts plain filename and content-type together
-        encrypted_name = cipher.encrypt(
-            padding(file_.clear_filename + '|' + file_.content_type))
-        metadata.encrypted_name = pickle.dumps(encrypted_name)
-        metadata.iv = pickle.dumps(metadata.iv)
-        metadata.save()
+        if not file_.metadata_in_header:
+            cipher = get_cipher_and_iv(
+                file_.passphrase, file_.iv, file_.kdf)[0]
+            metadata.size = file_.size
+            metadata.kdf = file_.kdf
+            metadata.compression = file_.compression
+            # Encrypts plain filename and content-type together
+            clear_name = file_.clear_filename + '|' + file_.content_type
+            encrypted_name = cipher.encrypt(
+                padding(clear_name.encode('utf-8')))
+            metadata.encrypted_name = encode_binary(encrypted_name)
+            metadata.key_check = key_check_value(
+                get_key(file_.passphrase, file_.iv, file_.kdf), file_.iv)
+            metadata.iv = encode_binary(file_.iv)
+        return metadata
+
+    @classmethod
+    def insert(cls, metadata):
+        ''' saves new metadata with a single INSERT '''
+        metadata.save(force_insert=True)
+        cache = get_cache()
+        if cache:
+            cache.set(cls.cache_key(metadata.file_id), metadata,
+                      settings.METADATA_CACHE_TTL)
         return metadata
 
+    @classmethod
+    def save_(cls, file_):
+        ''' writes metadata for a given file, with a single INSERT '''
+        return timed_query(file_, cls.insert, cls.build(file_))
+
     @classmethod
     def update(cls, file_, **kwargs):
-        ''' Updates metadata for a given file '''
+        ''' Updates metadata for a given file, with a single UPDATE '''
         from .storage import InexistentFile
 
-        try:
-            metadata = cls.objects.get(
-                file_id=file_.name)
-        except cls.DoesNotExist:
+        if not timed_query(
+                file_, cls.objects.filter(file_id=file_.name).update,
+                **kwargs):
             raise InexistentFile
-
-        for arg, val in kwargs.items():
-            setattr(metadata, arg, val)
-        metadata.save()
+        cache = get_cache()
+        if cache:
+            cache.delete(cls.cache_key(file_.name))
 
     @classmethod
-    def load(cls, file_):
-        ''' Load metadata for a given file. '''
-        from .storage import InexistentFile, ExpiredFile
-        try:
-            metadata = cls.objects.get(
-                file_id=file_.name)
-        except cls.DoesNotExist:
-            raise InexistentFile
+    def claim(cls, file_id):
+        ''' Deletes the metadata of a file. Returns False if it was already
+        gone: of concurrent claims, only one succeeds. '''
+        cache = get_cache()
+        if cache:
+            cache.delete(cls.cache_key(file_id))
+        connection = connections[router.db_for_write(cls)]
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE %s = %%s' % (
+                connection.ops.quote_name(cls._meta.db_table),
+                connection.ops.quote_name(cls._meta.pk.column)), [file_id])
+            claimed = cursor.rowcount == 1
+        if claimed:
+            file_claimed.send(sender=cls, file_id=file_id)
+        return claimed
 
-        for attr in ('size', 'one_time', 'iv', 'expire_date'):
-            setattr(file_, attr, getattr(metadata, attr, None))
+    @classmethod
+    def claim_many(cls, file_ids):
+        ''' Deletes the metadata of several files in a single statement, all
+        or none: returns False, deleting nothing, if any was already gone. '''
+        file_ids = list(set(file_ids))
+        cache = get_cache()
+        if cache:
+            cache.delete_many([cls.cache_key(file_id) for file_id in file_ids])
+        db = router.db_for_write(cls)
+        connection = connections[db]
+        with transaction.atomic(using=db):
+            with connection.cursor() as cursor:
+                cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+                    connection.ops.quote_name(cls._meta.db_table),
+                    connection.ops.quote_name(cls._meta.pk.column),
+                    ', '.join(['%s'] * len(file_ids))), file_ids)
+                claimed = cursor.rowcount == len(file_ids)
+            if not claimed:
+                # A concurrent download got one of them first
+                transaction.set_rollback(True, using=db)
+        if claimed:
+            for file_id in file_ids:
+                file_claimed.send(sender=cls, file_id=file_id)
+        return claimed
 
-        file_.iv = pickle.loads(file_.iv)
-        cipher = get_cipher_and_iv(file_.passphrase, file_.iv)[0]
-        encrypted_name = pickle.loads(metadata.encrypted_name)
-        file_.clear_filename, file_.content_type = \
-            cipher.decrypt(encrypted_name).split('|')
+    @classmethod
+    def load(cls, file_, metadata=None, claim=True):
+        ''' Load metadata for a given file, given its row if already fetched.
+        The passphrase is checked before anything is decrypted or deleted.
+        One-time files are claimed unless claim is False. '''
+        from .storage import ExpiredFile, InexistentFile, WrongPassphrase
+        if metadata is None:
+            metadata = timed_query(file_, cls.get, file_.name)
+        file_.one_time = metadata.one_time
+        file_.expire_date = metadata.expire_date
 
         # File access has expired
         if file_.expire_date and file_.expire_date < now():
-            metadata.delete()
+            timed_query(file_, cls.claim, file_.name)
             raise ExpiredFile('This file has expired')
 
+        if not metadata.iv:
+            # The rest of the metadata is in the file header
+            file_.load_header()
+        else:
+            file_.size = metadata.size
+            file_.kdf = metadata.kdf
+            file_.compression = metadata.compression
+            file_.iv = decode_binary(metadata.iv)
+            key = get_key(file_.passphrase, file_.iv, file_.kdf)
+            if metadata.key_check and \
+                    not verify_key(key, file_.iv, metadata.key_check):
+                raise WrongPassphrase
+
+            cipher = get_cipher_and_iv(
+                file_.passphrase, file_.iv, file_.kdf)[0]
+            encrypted_name = decode_binary(metadata.encrypted_name)
+            try:
+                file_.clear_filename, file_.content_type = cipher.decrypt(
+                    encrypted_name).rstrip('\x00').decode('utf-8').split('|')
+            except ValueError:
+                # Legacy file without key check value: garbage was decrypted
+                raise WrongPassphrase
+
         # File is accessed only once
-        if file_.one_time:
-            metadata.delete()
+        if claim and file_.one_time and \
+                not timed_query(file_, cls.claim, file_.name):
+            # A concurrent download got it first
+            raise InexistentFile
+
+
+class UploadSession(models.Model):
+    ''' Resumable upload of a segmented file.
+
+    The file is created with its header when the session is, then data is
+    appended at offset (in whole segments, but for the end of the file) by
+    as many requests as needed. The metadata row of the file is saved on
+    completion, the columns it gets from the session are computed up front.
+    '''
+
+    session_id = models.CharField(max_length=50, primary_key=True)
+
+    file_id = models.CharField(max_length=50)
+
+    # Declared clear size, and how much of it has been stored
+    length = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    segment_size = models.IntegerField()
+
+    # For multi-part uploads, the clear size of each part but the last (a
+    # multiple of segment_size), 0 for sequential uploads.
+    part_size = models.BigIntegerField(default=0)
+
+    # Key of the file and its check value
+    iv = models.CharField(max_length=50)
+    kdf = models.CharField(max_length=50, blank=True, default='')
+    key_check = models.CharField(max_length=64)
+
+    # Empty for files which keep their metadata in their header
+    encrypted_name = models.CharField(max_length=200, blank=True, default='')
+
+    # Expiration of the file once uploaded, in seconds
+    expire_after = models.IntegerField()
+    one_time = models.BooleanField(default=False)
+
+    # Expiration of the session
+    expire_date = models.DateTimeField(db_index=True)
+
+    @classmethod
+    def create_(cls, passphrase, clear_filename, content_type, length,
+                expire_date, one_time, part_size=0):
+        ''' starts the upload of a file of length clear bytes, sent in parts
+        of part_size bytes if given '''
+        from .entropy import new_file_id
+        from .storage import EncryptedUploadedFile, expire_after
+
+        file_ = EncryptedUploadedFile(
+            passphrase=passphrase, clear_filename=clear_filename,
+            content_type=content_type, content_length=length,
+            expire_date=expire_date, one_time=one_time,
+            file_format='segmented', compression='', expected_size=0)
+        if not length:
+            file_.finalize()
+        file_.file.close()
+
+        metadata = EncryptedUploadedFileMetaData.build(file_)
+        session = cls(
+            session_id=new_file_id(), file_id=file_.name, length=length,
+            segment_size=settings.SEGMENT_SIZE, iv=encode_binary(file_.iv),
+            kdf=file_.kdf, key_check=key_check_value(file_.key, file_.iv),
+            encrypted_name=metadata.encrypted_name,
+            expire_after=expire_after(expire_date),
+            one_time=one_time, part_size=part_size,
+            expire_date=now() + timedelta(
+                seconds=settings.UPLOAD_SESSION_TTL))
+        session.save(force_insert=True)
+        return session
+
+    @classmethod
+    def get_(cls, session_id):
+        ''' returns an upload session, raises InexistentFile if it is gone or
+        ExpiredFile if it has expired '''
+        from .storage import ExpiredFile, InexistentFile
+        try:
+            session = cls.objects.get(session_id=session_id)
+        except cls.DoesNotExist:
+            raise InexistentFile
+        if session.expire_date < now():
+            raise ExpiredFile('This upload session has expired')
+        return session
+
+    @property
+    def path(self):
+        ''' where the file is written: under its temporary name until
+        complete() renames it into place '''
+        from .storage import EncryptedFileSystemStorage
+        storage = EncryptedFileSystemStorage()
+        path = storage.path(self.file_id)
+        if os.path.exists(path):
+            return path
+        return storage.temp_path(self.file_id)
+
+    def get_key(self, passphrase):
+        ''' returns the file key, raises WrongPassphrase '''
+        from .storage import WrongPassphrase
+        iv = decode_binary(self.iv)
+        key = get_key(passphrase, iv, self.kdf)
+        if not verify_key(key, iv, self.key_check):
+            raise WrongPassphrase
+        return key
+
+    def append(self, passphrase, stream, offset):
+        ''' encrypts what is read from stream onto the file at offset, and
+        returns the new offset. Whatever is read of a partial segment (short
+        of the end of the file) is dropped: the client sends it again from
+        the returned offset. '''
+        from .segments import FileHeader, SegmentWriter, OVERHEAD
+        from .storage import UploadConflict
+
+        if self.part_size:
+            raise UploadConflict('Upload is sent in parts')
+        key = self.get_key(passphrase)
+        with open_for_writing(self.path, 'r+b') as file_:
+            try:
+                fcntl.flock(file_, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                raise UploadConflict('Upload in progress')
+            # Up to date now that concurrent requests are locked out
+            self.offset = type(self).objects.filter(
+                pk=self.pk).values_list('offset', flat=True).get()
+            if offset != self.offset:
+                raise UploadConflict('Upload is at offset %d' % self.offset)
+            if self.offset == self.length:
+                raise UploadConflict('Upload is complete')
+
+            header = FileHeader.read(file_)
+            first = self.offset // self.segment_size
+            # Drops whatever an interrupted request left past offset
+            file_.seek(header.size + first * (self.segment_size + OVERHEAD))
+            file_.truncate()
+            writer = SegmentWriter(file_, key, header, first)
+            received = 0
+            while True:
+                try:
+                    data = stream.read(writer.capacity)
+                except IOError:
+                    # Connection lost: whole segments received are kept
+                    break
+                if not data:
+                    break
+                received += len(data)
+                if self.offset + received > self.length:
+                    raise UploadConflict('Data past the declared length')
+                writer.write(data)
+            if self.offset + received == self.length:
+                writer.close()
+            else:
+                received -= writer.flush()
+            file_.flush()
+            sync_file(file_)
+            # Before the lock is released: a retry waiting for it must find
+            # the offset of what this request wrote
+            self.offset += received
+            type(self).objects.filter(pk=self.pk).update(offset=self.offset)
+        return self.offset
+
+    @property
+    def part_count(self):
+        return (self.length + self.part_size - 1) // self.part_size
+
+    def part_path(self, number):
+        return '%s.part%d' % (self.path, number)
+
+    def parts_done(self):
+        ''' returns the numbers of the parts received '''
+        return [number for number in range(self.part_count)
+                if os.path.exists(self.part_path(number))]
+
+    def write_part(self, passphrase, number, stream):
+        ''' encrypts part number of a multi-part upload, read from stream.
+        Parts are encrypted on their own, as the segments they end up as in
+        the file, and only kept once they have been received in full. '''
+        from .entropy import new_file_id
+        from .segments import FileHeader, SegmentWriter
+        from .storage import UploadConflict
+
+        if not self.part_size:
+            raise UploadConflict('Upload is not sent in parts')
+        if not 0 <= number < self.part_count:
+            raise UploadConflict('Upload has no part %d' % number)
+        key = self.get_key(passphrase)
+        start = number * self.part_size
+        size = min(self.part_size, self.length - start)
+
+        # Parts sent twice at once both end up complete, either one is kept
+        path = self.part_path(number)
+        temp_path = '%s.%s.tmp' % (path, new_file_id())
+        try:
+            with open_for_writing(temp_path) as file_:
+                writer = SegmentWriter(
+                    file_, key, FileHeader(self.segment_size),
+                    start // self.segment_size)
+                received = 0
+                while received < size:
+                    data = stream.read(min(writer.capacity, size - received))
+                    if not data:
+                        break
+                    received += len(data)
+                    writer.write(data)
+                if received < size or stream.read(1):
+                    raise UploadConflict('Part %d is %d bytes long' % (
+                        number, size))
+                if start + size == self.length:
+                    writer.close()
+                else:
+                    writer.flush()
+                sync_file(file_)
+            move_into_place(temp_path, path)
+        except:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+    def assemble(self):
+        ''' appends the parts of a multi-part upload to the file, in order '''
+        from .segments import FileHeader
+        from .storage import UploadConflict
+
+        missing = set(range(self.part_count)) - set(self.parts_done())
+        if missing:
+            raise UploadConflict('Upload is missing parts %s' % ', '.join(
+                str(number) for number in sorted(missing)))
+        with open_for_writing(self.path, 'r+b') as file_:
+            try:
+                fcntl.flock(file_, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                raise UploadConflict('Upload in progress')
+            # From right after the header, in case of an interrupted attempt
+            header = FileHeader.read(file_)
+            file_.seek(header.size)
+            file_.truncate()
+            for number in range(self.part_count):
+                with io.open(self.part_path(number), 'rb') as part:
+                    shutil.copyfileobj(part, file_, 1024 * 1024)
+            file_.flush()
+            sync_file(file_)
+            self.offset = self.length
+            type(self).objects.filter(pk=self.pk).update(offset=self.offset)
+        for number in range(self.part_count):
+            os.unlink(self.part_path(number))
+
+    def complete(self):
+        ''' saves the metadata of the uploaded file and ends the session '''
+        from .storage import UploadConflict
+        if self.part_size and self.offset != self.length:
+            self.assemble()
+        if self.offset != self.length:
+            raise UploadConflict('Upload is at offset %d' % self.offset)
+        path = self.path
+        if path.endswith(TEMP_SUFFIX):
+            move_into_place(path, path[:-len(TEMP_SUFFIX)])
+
+        metadata = EncryptedUploadedFileMetaData(
+            file_id=self.file_id, one_time=self.one_time,
+            expire_date=now() + timedelta(seconds=self.expire_after))
+        if self.encrypted_name:
+            metadata.size = self.length
+            metadata.iv = self.iv
+            metadata.kdf = self.kdf
+            metadata.key_check = self.key_check
+            metadata.encrypted_name = self.encrypted_name
+        try:
+            EncryptedUploadedFileMetaData.insert(metadata)
+        except IntegrityError:
+            raise UploadConflict('Upload is already complete')
+        self.delete()
+        return metadata
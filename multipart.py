@@ -0,0 +1,204 @@
+''' Streaming multipart/form-data scanner.
+
+Replaces django's LazyStream/ChunkIter/Parser stack for uploads: the request
+body is read in large blocks, boundaries are located with str.find, and part
+data is handed out as memoryview slices of the read buffer, aligned on the
+AES block size so they can go straight to the cipher without copies. '''
+
+import binascii
+
+from django.http.multipartparser import (
+    MultiPartParserError, parse_header, FIELD, FILE, RAW)
+
+from .metrics import NULL, clock
+
+
+DEFAULT_READ_SIZE = 256 * 1024
+MAX_HEADER_SIZE = 8 * 1024
+
+
+def parse_part_headers(header):
+    ''' returns the part type and a {name: (value, params)} dict, as
+    django.http.multipartparser.parse_boundary_stream does '''
+
+    item_type = RAW
+    meta_data = {}
+    for line in header.split('\r\n'):
+        main_value_pair, params = parse_header(line)
+        try:
+            name, value = main_value_pair.split(':', 1)
+        except ValueError:
+            continue
+        if name == 'content-disposition':
+            item_type = FIELD
+            if params.get('filename'):
+                item_type = FILE
+        meta_data[name] = value, params
+    return item_type, meta_data
+
+
+class MultiPartScanner(object):
+    ''' Iterates over the parts of a multipart body, yielding
+    (item_type, meta_data, part) tuples. part iterates over the part data as
+    memoryviews; whatever is left of it is skipped when moving to the next
+    part. '''
+
+    metrics = NULL
+
+    def __init__(self, stream, boundary, read_size=DEFAULT_READ_SIZE,
+                 align=16):
+        self.stream = stream
+        self.separator = '--' + boundary
+        self.delimiter = '\r\n' + self.separator
+        self.read_size = read_size
+        self.align = align
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.part = None
+
+    def _fill(self):
+        ''' reads the next block of the body, keeping the unparsed tail '''
+        if self.metrics:
+            started = clock()
+            data = self.stream.read(self.read_size)
+            self.metrics.add('read', clock() - started, len(data))
+        else:
+            data = self.stream.read(self.read_size)
+        if not data:
+            self.eof = True
+            return False
+        if self.pos < len(self.buffer):
+            self.buffer = self.buffer[self.pos:] + data
+        else:
+            self.buffer = data
+        self.pos = 0
+        return True
+
+    def _find(self, needle, error, skip=False):
+        ''' returns the buffer position of needle, reading as needed, or -1
+        at the end of the body. Raises MultiPartParserError(error) once more
+        than MAX_HEADER_SIZE bytes come before it; with skip, these bytes
+        are dropped as they are searched. '''
+        start = self.pos
+        skipped = 0
+        while True:
+            index = self.buffer.find(needle, start)
+            if index >= 0:
+                length = index - self.pos
+            else:
+                length = len(self.buffer) - self.pos - len(needle) + 1
+            if skipped + length > MAX_HEADER_SIZE:
+                raise MultiPartParserError(error)
+            if index >= 0:
+                return index
+            # Only the end of the buffer may hold the start of needle
+            start = max(len(self.buffer) - len(needle) + 1, self.pos)
+            if skip:
+                skipped += start - self.pos
+                self.pos = start
+            start -= self.pos
+            if not self._fill():
+                return -1
+
+    def __iter__(self):
+        index = self._find(
+            self.separator, 'Multipart preamble is too large.', skip=True)
+        if index < 0:
+            return
+        self.pos = index + len(self.separator)
+
+        while True:
+            # Transport padding, then either '--' (end) or CRLF (next part)
+            while len(self.buffer) - self.pos < 2 and self._fill():
+                pass
+            if self.buffer.startswith('--', self.pos) or self.eof:
+                return
+            index = self._find('\r\n', 'Boundary line is too large.')
+            if index < 0:
+                return
+            self.pos = index + 2
+
+            index = self._find('\r\n\r\n', 'Part headers are too large.')
+            if index < 0:
+                return
+            item_type, meta_data = parse_part_headers(
+                self.buffer[self.pos:index])
+            self.pos = index + 4
+
+            self.part = PartStream(self)
+            yield item_type, meta_data, self.part
+            self.part.exhaust()
+            if self.part.truncated:
+                return
+
+    def _part_chunks(self):
+        ''' yields the data of the current part up to the next delimiter '''
+        keep = len(self.delimiter) - 1
+        while True:
+            index = self.buffer.find(self.delimiter, self.pos)
+            if index >= 0:
+                if index > self.pos:
+                    yield memoryview(self.buffer)[self.pos:index]
+                self.pos = index + len(self.delimiter)
+                return
+            # Hands out as much aligned data as cannot be part of a
+            # delimiter straddling the end of the buffer.
+            end = len(self.buffer) - keep
+            end -= (end - self.pos) % self.align
+            if end > self.pos:
+                start, self.pos = self.pos, end
+                yield memoryview(self.buffer)[start:end]
+            if not self._fill():
+                # Truncated body
+                self.part.truncated = True
+                if self.pos < len(self.buffer):
+                    yield memoryview(self.buffer)[self.pos:]
+                self.pos = len(self.buffer)
+                return
+
+
+class PartStream(object):
+    ''' data of one part of a multipart body '''
+
+    def __init__(self, scanner):
+        self.chunks = scanner._part_chunks()
+        self.truncated = False
+
+    def __iter__(self):
+        return self.chunks
+
+    def read(self):
+        return ''.join(chunk.tobytes() for chunk in self.chunks)
+
+    def exhaust(self):
+        for chunk in self.chunks:
+            pass
+
+
+class Base64Decoder(object):
+    ''' Incremental decoder of base64 part data. Whitespace is dropped and
+    whatever is left of a 4-character quantum at the end of a chunk is
+    carried over to the next one. '''
+
+    def __init__(self):
+        self.carry = ''
+
+    def decode(self, chunk):
+        ''' returns the data decoded from chunk and what was carried over,
+        raises ValueError on invalid data '''
+        if isinstance(chunk, memoryview):
+            chunk = chunk.tobytes()
+        data = self.carry + chunk.translate(None, ' \t\r\n')
+        end = len(data) - len(data) % 4
+        self.carry = data[end:]
+        try:
+            return binascii.a2b_base64(data[:end])
+        except binascii.Error as e:
+            raise ValueError(str(e))
+
+    def flush(self):
+        ''' checks that no partial quantum is left '''
+        if self.carry:
+            raise ValueError('Truncated base64 data')
+        return ''
@@ -0,0 +1,201 @@
+''' Background removal of expired files.
+
+Rather than waiting for clean_secure_storage to scan the whole upload
+directory, a reaper thread removes files, and their metadata, as they
+expire. Every REAPER_INTERVAL seconds it loads the expiry dates due before
+its next load, from the expire_date index, into a min-heap which the
+uploads and claims of the process add to as they happen (post_save and
+file_claimed signals). Its cost is proportional to the files expiring, not
+to the files stored.
+
+The reaper is started lazily by the first file opened in a process when
+app_settings.REAPER is set. A single process per upload directory runs it,
+the one holding the lock on its .reaper file: files uploaded by the others
+are picked up by the next load. Files claimed by the others are not, as
+their metadata is gone: signals do not cross processes, so these are left
+to clean_secure_storage, which removes the files without metadata. '''
+
+import errno
+import fcntl
+import heapq
+import logging
+import os
+import threading
+import time
+from datetime import timedelta
+
+from django.db import connections
+from django.db.models.signals import post_save
+from django.utils.timezone import now
+
+import app_settings as settings
+from .models import EncryptedUploadedFileMetaData, file_claimed, get_cache
+
+
+logger = logging.getLogger('secure_storage.reaper')
+
+
+class Reaper(object):
+    ''' Removes files as they expire, and claimed files REAPER_GRACE seconds
+    after their claim (once their download has opened them). '''
+
+    def __init__(self, lock_file):
+        self.lock_file = lock_file
+        self.heap = []
+        self.next_load = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(
+            target=self.run, name='secure_storage reaper')
+        self.thread.daemon = True
+
+    def start(self):
+        post_save.connect(
+            self.file_saved, sender=EncryptedUploadedFileMetaData,
+            weak=False)
+        file_claimed.connect(self.file_claimed, weak=False)
+        self.thread.start()
+
+    def detach(self):
+        ''' leaves the reaper of a forked parent process behind '''
+        post_save.disconnect(
+            self.file_saved, sender=EncryptedUploadedFileMetaData)
+        file_claimed.disconnect(self.file_claimed)
+        self.lock_file.close()
+
+    def schedule(self, when, file_id):
+        ''' removes file_id at when '''
+        with self.condition:
+            heapq.heappush(self.heap, (when, file_id))
+            if self.heap[0][1] == file_id:
+                self.condition.notify()
+
+    def file_saved(self, sender, instance, created, **kwargs):
+        # Expiry dates past the next load are loaded then
+        if created and instance.expire_date and (
+                self.next_load is None or
+                instance.expire_date < self.next_load):
+            self.schedule(instance.expire_date, instance.file_id)
+
+    def file_claimed(self, sender, file_id, **kwargs):
+        self.schedule(
+            now() + timedelta(seconds=settings.REAPER_GRACE), file_id)
+
+    def load(self):
+        ''' adds the expiry dates due before the next load to the heap '''
+        next_load = now() + timedelta(seconds=settings.REAPER_INTERVAL)
+        rows = list(EncryptedUploadedFileMetaData.objects.filter(
+            expire_date__lt=next_load).order_by('expire_date').values_list(
+            'expire_date', 'file_id')[:settings.REAPER_HEAP_SIZE])
+        if len(rows) == settings.REAPER_HEAP_SIZE:
+            # The rest is loaded once these are removed
+            next_load = rows[-1][0]
+        with self.condition:
+            known = set(file_id for when, file_id in self.heap)
+            for row in rows:
+                if row[1] not in known:
+                    heapq.heappush(self.heap, row)
+            self.next_load = next_load
+
+    def pop_due(self):
+        ''' returns the ids of the files due for removal, up to
+        REAPER_BATCH_SIZE of them '''
+        current = now()
+        due = set()
+        with self.condition:
+            while self.heap and self.heap[0][0] <= current and \
+                    len(due) < settings.REAPER_BATCH_SIZE:
+                due.add(heapq.heappop(self.heap)[1])
+        return due
+
+    def reap(self, file_ids):
+        ''' removes the files of file_ids which have expired or have been
+        claimed, along with their metadata '''
+        from .storage import EncryptedFileSystemStorage
+
+        rows = EncryptedUploadedFileMetaData.objects.filter(
+            file_id__in=file_ids)
+        rows.filter(expire_date__lte=now()).delete()
+        # Files whose expiry date was pushed back meanwhile are kept
+        removed = file_ids - set(rows.values_list('file_id', flat=True))
+        cache = get_cache()
+        if cache:
+            cache.delete_many([
+                EncryptedUploadedFileMetaData.cache_key(file_id)
+                for file_id in removed])
+        storage = EncryptedFileSystemStorage()
+        for file_id in removed:
+            for path in set(storage.lookup_paths(file_id)):
+                try:
+                    os.unlink(path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+        logger.debug('Removed %d expired files', len(removed))
+
+    def wait(self):
+        ''' sleeps until the next removal or load is due '''
+        with self.condition:
+            deadline = self.next_load
+            if self.heap and self.heap[0][0] < deadline:
+                deadline = self.heap[0][0]
+            seconds = (deadline - now()).total_seconds()
+            if seconds > 0:
+                self.condition.wait(seconds)
+
+    def run(self):
+        while True:
+            try:
+                if self.next_load is None or now() >= self.next_load:
+                    self.load()
+                due = self.pop_due()
+                if due:
+                    self.reap(due)
+                    continue
+            except Exception:
+                logger.exception('Failed to remove expired files')
+                time.sleep(settings.REAPER_INTERVAL)
+                continue
+            finally:
+                # Not kept open while sleeping
+                for connection in connections.all():
+                    connection.close()
+            self.wait()
+
+
+_reaper = None
+_reaper_pid = None
+_attempted = 0
+_lock = threading.Lock()
+
+
+def start_reaper():
+    ''' starts the reaper in this process if app_settings.REAPER is set and
+    no other process runs it. Returns it, or None. '''
+    global _reaper, _reaper_pid, _attempted
+    if not settings.REAPER:
+        return None
+    if _reaper_pid == os.getpid() and (
+            _reaper or time.time() < _attempted + settings.REAPER_INTERVAL):
+        return _reaper
+    with _lock:
+        if _reaper_pid != os.getpid():
+            if _reaper is not None:
+                # Inherited from a forked parent, without its thread
+                _reaper.detach()
+            _reaper, _reaper_pid, _attempted = None, os.getpid(), 0
+        if _reaper is None and \
+                time.time() >= _attempted + settings.REAPER_INTERVAL:
+            _attempted = time.time()
+            lock_file = None
+            try:
+                lock_file = open(
+                    os.path.join(settings.UPLOAD_DIR, '.reaper'), 'a')
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # Another process runs the reaper, retried later on
+                if lock_file is not None:
+                    lock_file.close()
+            else:
+                _reaper = Reaper(lock_file)
+                _reaper.start()
+        return _reaper
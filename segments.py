@@ -0,0 +1,347 @@
+''' Segmented on-disk format.
+
+An encrypted file starts with a small header (magic, version, flags and
+segment size), optionally carrying the file metadata (see FileHeader),
+followed by fixed-size segments. Every segment is encrypted on
+its own with AES-GCM and stored as nonce + ciphertext + tag, so segments can
+be encrypted and decrypted in parallel and tampering is detected per segment.
+The segment index and a last-segment flag are authenticated along with each
+segment: segments cannot be reordered, and truncation is detected. '''
+
+import json
+import os
+import struct
+from multiprocessing.pool import ThreadPool
+
+import app_settings as settings
+from .encryption import (
+    encrypt_segment, decrypt_segment, seal, unseal, NONCE_SIZE, TAG_SIZE)
+from .metrics import NULL, clock
+
+
+MAGIC = 'SSEG'
+VERSION = 1
+HEADER = struct.Struct('>4sBBI')
+OVERHEAD = NONCE_SIZE + TAG_SIZE
+
+# Header flag: the file carries its own metadata, see FileHeader
+FLAG_METADATA = 1
+# IV, length of the KDF spec and size of the metadata slot
+METADATA_HEADER = struct.Struct('>16sBH')
+METADATA_SIZE = 1024
+
+_pool = None
+_pool_pid = None
+_green = None
+
+
+def is_green():
+    ''' whether threads are gevent greenlets, as in gunicorn's gevent
+    workers '''
+    global _green
+    if _green is None:
+        try:
+            from gevent import monkey
+        except ImportError:
+            _green = False
+        else:
+            _green = monkey.is_module_patched('threading')
+    return _green
+
+
+def get_pool():
+    ''' returns the per-process thread pool used for segment crypto.
+
+    Under gevent, crypto runs in a pool of real threads in any case: the
+    greenlet serving a transfer waits on it while the event loop goes on
+    serving the others. '''
+    global _pool, _pool_pid
+    green = is_green()
+    if settings.CRYPTO_THREADS <= 1 and not green:
+        return None
+    if _pool is None or _pool_pid != os.getpid():
+        # A pool inherited from a forked parent has no running threads.
+        if green:
+            from gevent.threadpool import ThreadPool as GreenThreadPool
+            _pool = GreenThreadPool(max(settings.CRYPTO_THREADS, 1))
+        else:
+            _pool = ThreadPool(settings.CRYPTO_THREADS)
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def offload(func, *args, **kwargs):
+    ''' returns func(*args, **kwargs), run in the crypto thread pool under
+    gevent so that it does not block the event loop '''
+    if not is_green():
+        return func(*args, **kwargs)
+    return get_pool().apply(func, args, kwargs)
+
+
+def parallel_map(func, jobs):
+    ''' maps func over jobs, spreading them across the crypto thread pool '''
+    pool = get_pool()
+    if pool is None or len(jobs) < 2 and not is_green():
+        return [func(job) for job in jobs]
+    return pool.map(func, jobs)
+
+
+class FileHeader(object):
+    ''' Header of a segmented file.
+
+    With FLAG_METADATA set, the header also holds the file IV and KDF spec in
+    the clear, followed by the file metadata (size, name, content type) as
+    JSON in a fixed-size slot sealed with AES-GCM. The clear part of the
+    header is authenticated along with the slot, which is sealed again in
+    place once the size is known. '''
+
+    def __init__(self, segment_size, iv=None, kdf='', metadata=None,
+                 slot=METADATA_SIZE):
+        self.segment_size = segment_size
+        self.iv = iv
+        self.kdf = kdf
+        self.metadata = metadata
+        self.slot = slot
+        self.sealed = None
+
+    @property
+    def flags(self):
+        return FLAG_METADATA if self.iv else 0
+
+    def clear_bytes(self):
+        data = HEADER.pack(MAGIC, VERSION, self.flags, self.segment_size)
+        if self.flags & FLAG_METADATA:
+            data += METADATA_HEADER.pack(
+                self.iv, len(self.kdf), self.slot) + self.kdf
+        return data
+
+    @property
+    def size(self):
+        ''' size of the header on disk, where the segments start '''
+        size = len(self.clear_bytes())
+        if self.flags & FLAG_METADATA:
+            size += self.slot + OVERHEAD
+        return size
+
+    def _encode(self):
+        data = json.dumps(self.metadata, ensure_ascii=False, sort_keys=True)
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        return data
+
+    def seal(self, key):
+        ''' returns the encrypted metadata slot '''
+        data = self._encode()
+        if len(data) > self.slot:
+            raise ValueError('File metadata do not fit in the header')
+        data += ' ' * (self.slot - len(data))
+        return seal(key, data, self.clear_bytes())
+
+    def unseal(self, key):
+        ''' decrypts the metadata slot. Raises ValueError if the key is wrong
+        or the header has been tampered with. '''
+        self.metadata = json.loads(
+            unseal(key, self.sealed, self.clear_bytes()))
+        return self.metadata
+
+    def write(self, file_, key):
+        if self.flags & FLAG_METADATA:
+            # Leaves room for the size to grow when sealed again
+            self.slot = max(self.slot, len(self._encode()) + 20)
+        file_.write(self.clear_bytes())
+        if self.flags & FLAG_METADATA:
+            file_.write(self.seal(key))
+
+    def rewrite(self, file_, key):
+        ''' seals the metadata slot again, in place '''
+        position = file_.tell()
+        file_.seek(len(self.clear_bytes()))
+        file_.write(self.seal(key))
+        file_.seek(position)
+
+    @classmethod
+    def read(cls, file_):
+        ''' reads the header of a segmented file, the metadata slot is left
+        sealed. Returns None for a legacy single-stream file (the file is then
+        rewound). '''
+        data = file_.read(HEADER.size)
+        if len(data) == HEADER.size:
+            magic, version, flags, segment_size = HEADER.unpack(data)
+            if magic == MAGIC and version == VERSION and segment_size:
+                header = cls(segment_size)
+                if flags & FLAG_METADATA:
+                    header._read_metadata(file_)
+                return header
+        file_.seek(0)
+        return None
+
+    def _read_metadata(self, file_):
+        from .storage import TamperedFile
+        data = file_.read(METADATA_HEADER.size)
+        if len(data) < METADATA_HEADER.size:
+            raise TamperedFile('Header is truncated')
+        self.iv, length, self.slot = METADATA_HEADER.unpack(data)
+        self.kdf = file_.read(length)
+        self.sealed = file_.read(self.slot + OVERHEAD)
+        if len(self.kdf) < length or len(self.sealed) < self.slot + OVERHEAD:
+            raise TamperedFile('Header is truncated')
+
+
+class SegmentWriter(object):
+    ''' Buffers plaintext and writes it out as encrypted segments.
+
+    Up to CRYPTO_THREADS segments are buffered in a preallocated buffer and
+    encrypted in parallel into a preallocated output buffer. Writes larger
+    than the buffer are encrypted straight from the caller's data.
+
+    Given first, the writer appends to a file which already has a header and
+    first segments, positioned where they end. '''
+
+    metrics = NULL
+
+    def __init__(self, file_, key, header=None, first=None):
+        self.file = file_
+        self.key = key
+        self.header = header or FileHeader(settings.SEGMENT_SIZE)
+        self.segment_size = self.header.segment_size
+        batch = max(settings.CRYPTO_THREADS, 1)
+        self.capacity = batch * self.segment_size
+        self.pending = bytearray(self.capacity)
+        self.filled = 0
+        self.output = memoryview(
+            bytearray(batch * (self.segment_size + OVERHEAD)))
+        if first is None:
+            self.header.write(self.file, self.key)
+        self.index = first or 0
+
+    def _encrypt(self, job):
+        index, data, last, output = job
+        encrypt_segment(self.key, index, data, last, output)
+
+    def _flush(self, data, last=False):
+        ''' encrypts data as consecutive segments and writes them out '''
+        size = self.segment_size
+        count = max((len(data) + size - 1) // size, 1)
+        jobs = []
+        end = 0
+        for i in range(count):
+            chunk = data[i * size:(i + 1) * size]
+            start = i * (size + OVERHEAD)
+            end = start + len(chunk) + OVERHEAD
+            jobs.append((
+                self.index + i, chunk, last and i == count - 1,
+                self.output[start:end]))
+        if self.metrics:
+            started = clock()
+            parallel_map(self._encrypt, jobs)
+            encrypted = clock()
+            self.file.write(self.output[:end])
+            self.metrics.add('encrypt', encrypted - started, len(data))
+            self.metrics.add('write', clock() - encrypted, end)
+        else:
+            parallel_map(self._encrypt, jobs)
+            self.file.write(self.output[:end])
+        self.index += count
+
+    def write(self, data):
+        view = memoryview(data)
+        while len(view):
+            if self.filled == self.capacity:
+                # More data follows: none of the buffered segments is the
+                # last one, which is only known on close().
+                self._flush(memoryview(self.pending))
+                self.filled = 0
+            if not self.filled and len(view) > self.capacity:
+                self._flush(view[:self.capacity])
+                view = view[self.capacity:]
+                continue
+            count = min(self.capacity - self.filled, len(view))
+            self.pending[self.filled:self.filled + count] = view[:count]
+            self.filled += count
+            view = view[count:]
+
+    def flush(self):
+        ''' writes out the whole segments buffered. What is left of a partial
+        segment stays buffered; returns its length. '''
+        whole = self.filled - self.filled % self.segment_size
+        if whole:
+            self._flush(memoryview(self.pending)[:whole])
+            self.pending[:self.filled - whole] = \
+                self.pending[whole:self.filled]
+            self.filled -= whole
+        return self.filled
+
+    def close(self):
+        ''' writes the remaining segments, flagging the last one. '''
+        self._flush(memoryview(self.pending)[:self.filled], last=True)
+
+
+class SegmentReader(object):
+    ''' Decrypting iterator over the segments of a file.
+
+    Segments are read with readinto() into a reusable buffer, a chunk of
+    chunk_size bytes at a time, and decrypted in parallel into a second
+    reusable buffer. The yielded memoryviews are only valid until the next
+    one is requested. '''
+
+    metrics = NULL
+
+    def __init__(self, file_, key, header, chunk_size=None):
+        self.file = file_
+        self.key = key
+        self.header = header
+        self.offset = header.size
+        self.segment_size = segment_size = header.segment_size
+        chunk_size = chunk_size or settings.DOWNLOAD_CHUNK_SIZE
+        self.batch = max(chunk_size // segment_size, 1)
+        self.stored = segment_size + OVERHEAD
+        body = os.fstat(self.file.fileno()).st_size - self.offset
+        self.count = (body + self.stored - 1) // self.stored
+        self.input = memoryview(bytearray(self.batch * self.stored))
+        self.output = memoryview(bytearray(self.batch * segment_size))
+
+    def _decrypt(self, job):
+        from .storage import TamperedFile
+        index, blob, output = job
+        try:
+            decrypt_segment(
+                self.key, index, blob, index == self.count - 1, output)
+        except ValueError:
+            raise TamperedFile('Segment %d failed authentication' % index)
+
+    def segments(self, first=0):
+        ''' yields the plaintext from segment first on, a batch of
+        consecutive segments at a time '''
+        from .storage import TamperedFile
+        if self.count < 1:
+            raise TamperedFile('File is truncated')
+        self.file.seek(self.offset + first * self.stored)
+        index = first
+        while index < self.count:
+            count = min(self.batch, self.count - index)
+            if self.metrics:
+                started = clock()
+            read = self.file.readinto(self.input[:count * self.stored])
+            # Only the last segment of the file may be short
+            size = read - (count - 1) * self.stored - OVERHEAD
+            if size < 0:
+                raise TamperedFile('File is truncated')
+            jobs = []
+            for i in range(count):
+                blob = self.input[i * self.stored:(i + 1) * self.stored]
+                start = i * self.segment_size
+                end = start + (size if i == count - 1 else self.segment_size)
+                jobs.append((index + i, blob[:end - start + OVERHEAD],
+                             self.output[start:end]))
+            if self.metrics:
+                decrypted = clock()
+                parallel_map(self._decrypt, jobs)
+                self.metrics.add('read', decrypted - started, read)
+                self.metrics.add('decrypt', clock() - decrypted, end)
+            else:
+                parallel_map(self._decrypt, jobs)
+            yield self.output[:end]
+            index += count
+
+    def __iter__(self):
+        return self.segments()
@@ -1,15 +1,34 @@
 
-from uuid import uuid4
+import errno
+import io
+import os
 from django.utils.timezone import now
 from datetime import timedelta
-from os.path import join
+from os.path import dirname, isdir, join
 from django.core.files.storage import FileSystemStorage
 from django.core.files.uploadedfile import UploadedFile
 
-from .encryption import get_cipher_and_iv, padding
+from .encryption import (
+    current_kdf, get_cipher_and_iv, get_key, new_cbc, padding, BLOCK_SIZE)
+from .compression import Compressor, choose_compression, decompress
+from .durability import (
+    TEMP_SUFFIX, move_into_place, open_for_writing, preallocate, sync_file)
+from .entropy import new_file_id
+from .metrics import NULL, clock, timed
+from .reaper import start_reaper
+from .segments import (
+    FileHeader, SegmentReader, SegmentWriter, OVERHEAD, offload)
 import app_settings as settings
 from .models import EncryptedUploadedFileMetaData
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 
 class ExpiredFile(Exception):
     pass
@@ -19,6 +38,74 @@ class InexistentFile(Exception):
     pass
 
 
+class TamperedFile(Exception):
+    pass
+
+
+class WrongPassphrase(Exception):
+    pass
+
+
+class UploadConflict(Exception):
+    pass
+
+
+def expire_after(expire_date):
+    ''' returns for how many seconds an upload is kept given its expire_date
+    choice. By default, and for one-time files (expire_date 0, which then
+    expire on first download), we set an arbitrary 10 years. '''
+    return int(expire_date or 0) or 10 * settings.ONE_YEAR
+
+
+class CBCWriter(object):
+    ''' Legacy single-stream writer: data is encrypted as it comes into a
+    reusable output buffer. The trailing partial block is carried over to
+    the next write and zero-padded once, on close(). '''
+
+    metrics = NULL
+
+    def __init__(self, file_, cipher):
+        self.file = file_
+        self.cipher = cipher
+        self.carry = bytearray()
+        self.output = bytearray()
+
+    def _encrypt(self, data):
+        if len(self.output) < len(data):
+            self.output = bytearray(len(data))
+        output = memoryview(self.output)[:len(data)]
+        if self.metrics:
+            started = clock()
+            offload(self.cipher.encrypt, data, output=output)
+            encrypted = clock()
+            self.file.write(output)
+            self.metrics.add('encrypt', encrypted - started, len(data))
+            self.metrics.add('write', clock() - encrypted, len(data))
+        else:
+            offload(self.cipher.encrypt, data, output=output)
+            self.file.write(output)
+
+    def write(self, data):
+        view = memoryview(data)
+        if self.carry:
+            count = min(BLOCK_SIZE - len(self.carry), len(view))
+            self.carry += view[:count]
+            view = view[count:]
+            if len(self.carry) < BLOCK_SIZE:
+                return
+            self._encrypt(self.carry)
+            del self.carry[:]
+        aligned = len(view) - len(view) % BLOCK_SIZE
+        if aligned:
+            self._encrypt(view[:aligned])
+        self.carry += view[aligned:]
+
+    def close(self):
+        if self.carry:
+            self._encrypt(padding(bytes(self.carry)))
+            del self.carry[:]
+
+
 class EncryptedUploadedFile(UploadedFile):
     ''' Extends the django builtin UploadedFile.
     The written file is encrypted using AES-256 cipher. '''
@@ -26,84 +113,341 @@ class EncryptedUploadedFile(UploadedFile):
     def __init__(self, *args, **kwargs):
 
         self.passphrase = kwargs.pop('passphrase')
+        self.metrics = kwargs.pop('metrics', NULL)
         self.name = kwargs.get('name')
+        start_reaper()
 
         if self.name:
             self._open_existing_file(*args, **kwargs)
         else:
             self._open_new_file(*args, **kwargs)
 
+    @classmethod
+    def check(cls, name, passphrase, metadata=None):
+        ''' checks the passphrase of a file, and that it has not expired,
+        without opening it: only the header of files which keep their
+        metadata in it is read. Raises as opening the file would. '''
+        file_ = cls.__new__(cls)
+        file_.name, file_.passphrase, file_.metrics = name, passphrase, NULL
+        file_.file = None
+        EncryptedUploadedFileMetaData.load(file_, metadata, claim=False)
+        if file_.file is not None:
+            file_.file.close()
+
     def _open_existing_file(self, *args, **kwargs):
-        self.file = self.open_file(mode='rb')
+        # Metadata goes first: a wrong passphrase is rejected before any
+        # file I/O, or once the header is read for files which keep their
+        # metadata in it (see load_header).
+        metadata = kwargs.pop('metadata', None)
+        claim = kwargs.pop('claim', True)
+        self.file = self.header = None
+        EncryptedUploadedFileMetaData.load(self, metadata, claim)
+        if self.file is None:
+            self.file = self.open_file(mode='rb')
+            self.header = FileHeader.read(self.file)
+        kwargs.update(size=self.size, content_type=self.content_type)
         super(EncryptedUploadedFile, self).__init__(self.file, **kwargs)
-        EncryptedUploadedFileMetaData.load(self)
-        self.cipher = get_cipher_and_iv(self.passphrase, self.iv)[0]
+        self.key = get_key(self.passphrase, self.iv, self.kdf)
+        self.writer = None
+        if self.header:
+            self.cipher = None
+            self.reader = SegmentReader(self.file, self.key, self.header)
+            self.reader.metrics = self.metrics
+        else:
+            # Legacy single-stream CBC file
+            self.cipher = new_cbc(self.key, self.iv)[0]
+            self.reader = None
 
     def _open_new_file(self, *args, **kwargs):
-        self.cipher, self.iv = get_cipher_and_iv(self.passphrase)
+        self.kdf = current_kdf()
+        self.cipher, self.iv = get_cipher_and_iv(
+            self.passphrase, kdf=self.kdf)
+        self.key = get_key(self.passphrase, self.iv, self.kdf)
         self.name = EncryptedFileSystemStorage().get_available_name()
         self.file = self.open_file(mode='wb')
+        self.reader = None
 
-        # By default, we set an arbitrary 10 years expiration date.
-        expire = int(kwargs.pop('expire_date', 10 * settings.ONE_YEAR))
-        self.expire_date = now() + timedelta(seconds=expire)
+        self.expire_date = now() + timedelta(
+            seconds=expire_after(kwargs.pop('expire_date', None)))
 
         self.clear_filename = kwargs.pop('clear_filename')
         self.one_time = kwargs.pop('one_time', False)
-        kwargs['size'] = int(kwargs.pop('content_length', 0))
-        
+        kwargs['size'] = int(kwargs.pop('content_length', 0) or 0)
+        file_format = kwargs.pop('file_format', settings.FILE_FORMAT)
+        compression = kwargs.pop('compression', None)
+        # Upper bound of the size, to preallocate
+        expected_size = kwargs.pop('expected_size', None)
+
         super(EncryptedUploadedFile, self).__init__(
             self.file, self.name, **kwargs)
-        EncryptedUploadedFileMetaData.save_(self)
 
+        self.header = None
+        self.compression = ''
+        self.compressor = None
+        if file_format == 'segmented':
+            if compression is None:
+                compression = choose_compression(self.content_type)
+            if compression:
+                self.compression = compression
+                self.compressor = Compressor(compression)
+            if settings.METADATA_STORAGE == 'header':
+                self.header = FileHeader(
+                    settings.SEGMENT_SIZE, self.iv, self.kdf, dict(
+                        size=self.size, name=self.clear_filename,
+                        content_type=self.content_type,
+                        compression=self.compression))
+            self.writer = SegmentWriter(self.file, self.key, self.header)
+        else:
+            self.writer = CBCWriter(self.file, self.cipher)
+        self.writer.metrics = self.metrics
+        try:
+            self.preallocated = self.preallocate(
+                self.size if expected_size is None else expected_size)
+        except:
+            # Not yet handed out: nobody else discards it
+            self.discard()
+            raise
+
+    def preallocate(self, size):
+        ''' preallocates what size clear bytes take on disk, returns whether
+        it did '''
+        if not size:
+            return False
+        if isinstance(self.writer, SegmentWriter):
+            segment_size = self.writer.segment_size
+            size = (size + segment_size - 1) // segment_size * (
+                segment_size + OVERHEAD)
+        else:
+            size += BLOCK_SIZE
+        return preallocate(self.file, self.file.tell() + size)
 
     @property
-    def path(self):
-        return join(settings.UPLOAD_DIR, self.name)
+    def metadata_in_header(self):
+        ''' whether the file keeps its metadata in its header '''
+        return bool(self.header and self.header.iv)
 
-    def open_file(self, mode='rb'):
+    def load_header(self):
+        ''' reads the metadata of a file which keeps it in its header.
+        Raises WrongPassphrase if the header cannot be decrypted. '''
+        self.file = self.open_file(mode='rb')
         try:
-            return open(self.path, mode)
-        except IOError:
-            if mode == 'rb':
-                raise InexistentFile
+            self.header = FileHeader.read(self.file)
+            if not self.metadata_in_header:
+                raise TamperedFile('File has no metadata header')
+            self.iv, self.kdf = self.header.iv, self.header.kdf
+            metadata = self.header.unseal(
+                get_key(self.passphrase, self.iv, self.kdf))
+        except ValueError:
+            self.file.close()
+            raise WrongPassphrase
+        except TamperedFile:
+            self.file.close()
             raise
-                
+        self.size = metadata['size']
+        self.clear_filename = metadata['name']
+        self.content_type = metadata['content_type']
+        self.compression = metadata.get('compression', '')
+
+    @property
+    def path(self):
+        return EncryptedFileSystemStorage().path(self.name)
+
+    def open_file(self, mode='rb'):
+        storage = EncryptedFileSystemStorage()
+        if mode == 'rb':
+            for path in storage.lookup_paths(self.name):
+                try:
+                    return io.open(path, mode)
+                except IOError:
+                    pass
+            raise InexistentFile
+        storage.make_shard(self.name)
+        # Renamed into place by finalize()
+        return open_for_writing(storage.temp_path(self.name), mode)
+
     def encrypt_and_write(self, raw_data):
-        if raw_data:
-            block = self.cipher.encrypt(padding(raw_data))
-            self.write(block)
+        if self.compressor:
+            if self.metrics:
+                started = clock()
+                size = len(raw_data)
+                raw_data = self.compressor.compress(raw_data)
+                self.metrics.add('compress', clock() - started, size)
+            else:
+                raw_data = self.compressor.compress(raw_data)
+        self.writer.write(raw_data)
+
+    def finalize(self):
+        ''' writes out whatever encrypted data is still buffered, and
+        renames the complete file into place '''
+        if self.writer:
+            if self.compressor:
+                self.writer.write(self.compressor.flush())
+                self.compressor = None
+            self.writer.close()
+            self.writer = None
+            if self.metadata_in_header:
+                # The size is only known now
+                self.header.metadata['size'] = self.size
+                self.header.rewrite(self.file, self.key)
+            if self.preallocated:
+                # Drops the space preallocated past the end
+                self.file.truncate()
+            sync_file(self.file)
+            storage = EncryptedFileSystemStorage()
+            move_into_place(storage.temp_path(self.name), self.path)
+
+    def discard(self):
+        ''' drops a new file which is not to be completed '''
+        self.writer = self.compressor = None
+        self.file.close()
+        try:
+            os.unlink(EncryptedFileSystemStorage().temp_path(self.name))
+        except OSError:
+            pass
+
+    def chunks(self, chunk_size=None, start=0, stop=None):
+        ''' decrypting iterator over the clear bytes [start, stop).
+        Only the segments or cipher blocks covering the range are read,
+        but for compressed files which are decompressed from the start.
+        Data is read and decrypted into reusable buffers: the only object
+        allocated per chunk is the yielded string. '''
+
+        if stop is None or stop > self.size:
+            stop = self.size
+        if start >= stop:
+            return
+
+        if self.compression:
+            blocks = decompress(
+                self.compression, self.reader.segments(),
+                chunk_size or settings.DOWNLOAD_CHUNK_SIZE)
+            if self.metrics:
+                blocks = timed(blocks, self.metrics, 'decompress',
+                               ('read', 'decrypt'))
+            position = 0
+        elif self.reader:
+            first = start // self.reader.segment_size
+            blocks = self.reader.segments(first)
+            position = first * self.reader.segment_size
+        else:
+            blocks = self._cbc_blocks(chunk_size, start)
+            position = start - start % BLOCK_SIZE
 
-    def chunks(self, chunk_size=None):
-        ''' decrypting iterator '''
+        for block in blocks:
+            end = position + len(block)
+            if end > start:
+                # Trims the head of the range and the padding at the end
+                yield block[max(start - position, 0):stop - position].tobytes()
+            position = end
+            if position >= stop:
+                break
+
+    def _cbc_blocks(self, chunk_size, start):
+        ''' decrypts a legacy CBC stream from the cipher block holding start.
+        CBC decrypts from any block given the previous ciphertext block. '''
+
+        chunk_size = chunk_size or settings.DOWNLOAD_CHUNK_SIZE
+        chunk_size -= chunk_size % BLOCK_SIZE
+        block = start // BLOCK_SIZE
+        if block:
+            self.file.seek((block - 1) * BLOCK_SIZE)
+            iv = self.file.read(BLOCK_SIZE)
+            cipher = new_cbc(self.key, iv)[0]
+        else:
+            self.file.seek(0)
+            cipher = self.cipher
 
-        if not chunk_size:
-            chunk_size = self.DEFAULT_CHUNK_SIZE
-        read = 0
+        input_ = memoryview(bytearray(chunk_size))
+        output = memoryview(bytearray(chunk_size))
+        metrics = self.metrics
         while True:
-            block = self.read(chunk_size)
-            if len(block) == 0:
+            if metrics:
+                started = clock()
+            read = self.file.readinto(input_)
+            if not read:
                 # EOF
                 break
-            block = self.cipher.decrypt(block)
-            read += len(block)
-            if read > self.size:
-                # We remove the padding at the end of the file
-                padding = self.size - read
-                block = block[:padding]
-            yield block
+            if metrics:
+                decrypted = clock()
+                offload(cipher.decrypt, input_[:read], output=output[:read])
+                metrics.add('read', decrypted - started, read)
+                metrics.add('decrypt', clock() - decrypted, read)
+            else:
+                offload(cipher.decrypt, input_[:read], output=output[:read])
+            yield output[:read]
+
+
+def listdir(directory):
+    ''' yields (name, is_dir) for the entries of directory, without listing
+    it all at once when scandir is available '''
+    if scandir is None:
+        for name in os.listdir(directory):
+            yield name, isdir(join(directory, name))
+    else:
+        for entry in scandir(directory):
+            yield entry.name, entry.is_dir()
 
 
 class EncryptedFileSystemStorage(FileSystemStorage):
-    ''' handles encrypted files on disk with random names '''
+    ''' handles encrypted files on disk with random names.
+
+    Files are spread over SHARD_DEPTH levels of directories named after
+    SHARD_WIDTH characters of their id: ab/cd/abcd... Files stored flat in
+    the upload directory (before sharding, or until shard_secure_storage
+    has moved them) are still found. '''
 
     def __init__(self, location=settings.UPLOAD_DIR):
         super(EncryptedFileSystemStorage, self).__init__(location)
 
     def open(self, *args, **kwargs):
         return EncryptedUploadedFile(*args, **kwargs)
-        
+
     def get_available_name(self):
         ''' return a random id for the upload file '''
-        file_id = str(uuid4()).replace("-", "")
-        return join(self.location, file_id)
+        return join(self.location, new_file_id())
+
+    def shard(self, name):
+        ''' returns the shard directories of a file '''
+        width, depth = settings.SHARD_WIDTH, settings.SHARD_DEPTH
+        if len(name) <= width * depth:
+            return ()
+        return tuple(name[i * width:(i + 1) * width] for i in range(depth))
+
+    def path(self, name):
+        ''' returns where a file is stored in the sharded layout '''
+        return join(self.location, *(self.shard(name) + (name,)))
+
+    def temp_path(self, name):
+        ''' returns where a file is written until it is complete '''
+        return self.path(name) + TEMP_SUFFIX
+
+    def lookup_paths(self, name):
+        ''' returns the paths to look a file up at. The sharded path is
+        tried again last, in case the file was moved there meanwhile. '''
+        path = self.path(name)
+        flat_path = join(self.location, name)
+        if path == flat_path:
+            return (path,)
+        return (path, flat_path, path)
+
+    def make_shard(self, name):
+        ''' creates the shard directories of a file '''
+        try:
+            os.makedirs(dirname(self.path(name)))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def iter_files(self, directory=None, depth=0):
+        ''' yields (name, path) for every stored file, at any shard level.
+        Dot files (such as the reaper lock) are not stored files. '''
+        directory = directory or self.location
+        for name, is_dir in listdir(directory):
+            if name.startswith('.'):
+                continue
+            path = join(directory, name)
+            if not is_dir:
+                yield name, path
+            elif depth < settings.SHARD_DEPTH:
+                for item in self.iter_files(path, depth + 1):
+                    yield item
@@ -0,0 +1,80 @@
+''' Helpers for streaming responses. '''
+
+import sys
+from collections import deque
+from threading import Condition, Thread
+
+
+class PipelinedIterator(object):
+    ''' Drives an iterator (e.g. a decrypting EncryptedUploadedFile.chunks())
+    from a background thread, keeping up to depth items and max_bytes ahead
+    of the consumer, so that reading and decrypting overlap with sending.
+
+    close() is called by the WSGI server through StreamingHttpResponse when
+    the response ends or the client disconnects; it stops the producer. '''
+
+    def __init__(self, iterable, depth, max_bytes):
+        self.iterator = iter(iterable)
+        self.depth = max(depth, 1)
+        self.max_bytes = max_bytes
+        self.queue = deque()
+        self.buffered = 0
+        self.done = False
+        self.closed = False
+        self.error = None
+        self.condition = Condition()
+        self.thread = Thread(target=self._produce)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _is_full(self, size):
+        # A single item larger than max_bytes is still let through alone.
+        return self.queue and (
+            len(self.queue) >= self.depth or
+            self.buffered + size > self.max_bytes)
+
+    def _produce(self):
+        try:
+            for item in self.iterator:
+                with self.condition:
+                    while not self.closed and self._is_full(len(item)):
+                        self.condition.wait()
+                    if self.closed:
+                        break
+                    self.queue.append(item)
+                    self.buffered += len(item)
+                    self.condition.notify_all()
+        except Exception:
+            self.error = sys.exc_info()
+        finally:
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+            if hasattr(self.iterator, 'close'):
+                self.iterator.close()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        with self.condition:
+            while not self.queue and not self.done:
+                self.condition.wait()
+            if self.queue:
+                item = self.queue.popleft()
+                self.buffered -= len(item)
+                self.condition.notify_all()
+                return item
+        if self.error:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
+        raise StopIteration
+
+    __next__ = next
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.queue.clear()
+            self.buffered = 0
+            self.condition.notify_all()
@@ -0,0 +1,537 @@
+import base64
+import errno
+import io
+import json
+import os
+import pickle
+import zipfile
+
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.http.multipartparser import MultiPartParserError
+from django.test import SimpleTestCase, TestCase
+from django.utils.timezone import now
+
+import app_settings as settings
+from . import durability
+from .models import (
+    EncryptedUploadedFileMetaData, UploadSession, decode_binary)
+from .multipart import Base64Decoder, MAX_HEADER_SIZE, MultiPartScanner
+from .reaper import Reaper
+from .segments import HEADER, OVERHEAD
+from .storage import (
+    EncryptedFileSystemStorage, EncryptedUploadedFile, TamperedFile)
+from .views import parse_range
+from .zipstream import ZIP64_LIMIT, ZipStream
+
+
+BOUNDARY = 'BoUnDaRyStRiNg'
+PASSPHRASE = 'x' * 32
+
+
+def multipart_body(data, expire_date='3600'):
+    ''' returns the body of an upload of data, with a passphrase '''
+    lines = []
+    for name, value in (('passphrase', PASSPHRASE),
+                        ('expire_date', expire_date)):
+        lines.extend([
+            '--' + BOUNDARY,
+            'Content-Disposition: form-data; name="%s"' % name,
+            '', value])
+    lines.extend([
+        '--' + BOUNDARY,
+        'Content-Disposition: form-data; name="file"; filename="data.bin"',
+        'Content-Type: application/octet-stream',
+        '', data,
+        '--' + BOUNDARY + '--', ''])
+    return '\r\n'.join(lines)
+
+
+class StorageTestCase(TestCase):
+
+    def setUp(self):
+        if not os.path.isdir(settings.UPLOAD_DIR):
+            os.makedirs(settings.UPLOAD_DIR)
+
+    def stored_files(self):
+        return set(name for name, path in
+                   EncryptedFileSystemStorage().iter_files())
+
+    def upload(self, body):
+        return self.client.generic(
+            'POST', reverse('secure-storage-upload'), body,
+            content_type='multipart/form-data; boundary=%s' % BOUNDARY)
+
+    def upload_file(self, data, expire_date='3600'):
+        ''' uploads data, returns its file id '''
+        response = self.upload(multipart_body(data, expire_date))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)['file_id']
+
+    def download(self, file_id, **extra):
+        return self.client.post(
+            reverse('secure-storage-download'),
+            {'file_id': file_id, 'passphrase': PASSPHRASE}, **extra)
+
+    def download_content(self, file_id, **extra):
+        response = self.download(file_id, **extra)
+        self.assertIn(response.status_code, (200, 206))
+        return ''.join(response.streaming_content)
+
+
+class UploadTest(StorageTestCase):
+
+    def test_upload(self):
+        before = self.stored_files()
+        response = self.upload(multipart_body(os.urandom(300000)))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.stored_files() - before), 1)
+
+    def test_base64_upload(self):
+        data = os.urandom(300001)
+        body = multipart_body(base64.encodestring(data)).replace(
+            'Content-Type: application/octet-stream',
+            'Content-Type: application/octet-stream\r\n'
+            'Content-Transfer-Encoding: base64')
+        response = self.upload(body)
+        self.assertEqual(response.status_code, 200)
+        file_id = json.loads(response.content)['file_id']
+        self.assertEqual(self.download_content(file_id), data)
+
+    def test_one_time_upload(self):
+        response = self.upload(multipart_body('data', expire_date='0'))
+        content = json.loads(response.content)
+        self.assertEqual(content['expire_on'], 'first download')
+        metadata = EncryptedUploadedFileMetaData.objects.get(
+            file_id=content['file_id'])
+        self.assertTrue(metadata.one_time)
+        self.assertGreater(metadata.expire_date, now())
+        self.assertEqual(self.download_content(content['file_id']), 'data')
+        self.assertEqual(self.download(content['file_id']).status_code, 404)
+
+    def test_truncated_upload(self):
+        ''' a body cut short is not stored, even partially '''
+        before = self.stored_files()
+        response = self.upload(multipart_body(os.urandom(300000))[:200000])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.stored_files(), before)
+
+    def test_no_space_left(self):
+        ''' a file which cannot be preallocated is not left behind '''
+        def fallocate(fd, offset, length):
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        before = self.stored_files()
+        saved = durability._fallocate, settings.PREALLOCATE
+        durability._fallocate, settings.PREALLOCATE = fallocate, True
+        try:
+            with self.assertRaises(IOError):
+                EncryptedUploadedFile(
+                    passphrase=PASSPHRASE, clear_filename='data.bin',
+                    content_type='application/octet-stream',
+                    content_length=10 ** 6)
+        finally:
+            durability._fallocate, settings.PREALLOCATE = saved
+        self.assertEqual(self.stored_files(), before)
+
+
+class BatchDownloadTest(StorageTestCase):
+
+    def test_one_time_files_outlive_sweeps(self):
+        ''' claimed one-time files are still streamed when the reaper and
+        clean_secure_storage remove them mid-download '''
+        contents = [os.urandom(300000) for i in range(3)]
+        file_ids = [self.upload_file(contents[0])] + [
+            self.upload_file(data, expire_date='0') for data in contents[1:]]
+        response = self.client.post(
+            reverse('secure-storage-download-batch'),
+            {'file_id': file_ids, 'passphrase': [PASSPHRASE] * 3})
+        self.assertEqual(response.status_code, 200)
+        stream = iter(response.streaming_content)
+        body = next(stream)
+
+        self.assertFalse(EncryptedUploadedFileMetaData.objects.filter(
+            file_id__in=file_ids[1:]).exists())
+        call_command('clean_secure_storage', min_age=0, stdout=io.BytesIO())
+        Reaper(None).reap(set(file_ids[1:]))
+        self.assertTrue(self.stored_files().isdisjoint(file_ids[1:]))
+
+        body += ''.join(stream)
+        archive = zipfile.ZipFile(io.BytesIO(body))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(
+            [archive.read(name) for name in archive.namelist()], contents)
+
+
+class MultiPartScannerTest(SimpleTestCase):
+
+    def scan(self, stream):
+        return [(item_type, meta_data, part.read()) for
+                item_type, meta_data, part in
+                MultiPartScanner(stream, BOUNDARY, read_size=4096)]
+
+    def test_parts(self):
+        parts = self.scan(io.BytesIO(multipart_body('data')))
+        self.assertEqual([data for item_type, meta_data, data in parts],
+                         [PASSPHRASE, '3600', 'data'])
+
+    def test_unterminated_header(self):
+        ''' a part header without end is refused before it is all read '''
+        stream = io.BytesIO(
+            '--%s\r\nContent-Disposition: form-data; name="a"; x="%s"' % (
+                BOUNDARY, 'x' * 10 ** 6))
+        with self.assertRaises(MultiPartParserError):
+            self.scan(stream)
+        self.assertLess(stream.tell(), MAX_HEADER_SIZE + 3 * 4096)
+
+    def test_long_preamble(self):
+        stream = io.BytesIO('x' * 10 ** 6 + multipart_body('data'))
+        with self.assertRaises(MultiPartParserError):
+            self.scan(stream)
+        self.assertLess(stream.tell(), MAX_HEADER_SIZE + 3 * 4096)
+
+
+class SegmentedFormatTest(StorageTestCase):
+
+    def setUp(self):
+        super(SegmentedFormatTest, self).setUp()
+        self.data = os.urandom(3 * settings.SEGMENT_SIZE + 100)
+        self.file_id = self.upload_file(self.data)
+        self.path = EncryptedFileSystemStorage().path(self.file_id)
+        with open(self.path, 'rb') as file_:
+            self.raw = file_.read()
+        self.segment = settings.SEGMENT_SIZE + OVERHEAD
+
+    def segments(self):
+        ''' returns the header and the segments of the file '''
+        return self.raw[:HEADER.size], [
+            self.raw[start:start + self.segment] for start in
+            range(HEADER.size, len(self.raw), self.segment)]
+
+    def assertTampered(self, raw):
+        with open(self.path, 'wb') as file_:
+            file_.write(raw)
+        with self.assertRaises(TamperedFile):
+            self.download_content(self.file_id)
+
+    def test_round_trip(self):
+        self.assertEqual(self.raw[:4], 'SSEG')
+        self.assertEqual(self.download_content(self.file_id), self.data)
+
+    def test_flipped_byte(self):
+        raw = bytearray(self.raw)
+        raw[HEADER.size + self.segment + 100] ^= 1
+        self.assertTampered(bytes(raw))
+
+    def test_truncated_on_segment_boundary(self):
+        header, segments = self.segments()
+        self.assertTampered(header + ''.join(segments[:2]))
+
+    def test_reordered_segments(self):
+        header, segments = self.segments()
+        segments[0], segments[1] = segments[1], segments[0]
+        self.assertTampered(header + ''.join(segments))
+
+    def test_appended_segment(self):
+        header, segments = self.segments()
+        self.assertTampered(header + ''.join(segments + segments[1:2]))
+
+
+class LegacyFormatTest(StorageTestCase):
+
+    def setUp(self):
+        super(LegacyFormatTest, self).setUp()
+        self.saved = settings.FILE_FORMAT, settings.KDF
+        settings.FILE_FORMAT, settings.KDF = 'cbc', ''
+
+    def tearDown(self):
+        settings.FILE_FORMAT, settings.KDF = self.saved
+
+    def test_pickled_cbc_round_trip(self):
+        ''' a CBC file whose row was written by older versions: pickled
+        iv and name, no key check value '''
+        data = os.urandom(100003)
+        file_id = self.upload_file(data)
+        with open(EncryptedFileSystemStorage().path(file_id), 'rb') as file_:
+            self.assertNotEqual(file_.read(4), 'SSEG')
+        metadata = EncryptedUploadedFileMetaData.objects.get(file_id=file_id)
+        self.assertEqual(metadata.kdf, '')
+        EncryptedUploadedFileMetaData.objects.filter(file_id=file_id).update(
+            iv=pickle.dumps(decode_binary(metadata.iv)),
+            encrypted_name=pickle.dumps(
+                decode_binary(metadata.encrypted_name)),
+            key_check='')
+        self.assertEqual(self.download_content(file_id), data)
+
+
+class RangeTest(StorageTestCase):
+
+    def test_parse_range(self):
+        for header, byte_range in (
+                ('bytes=0-99', (0, 100)),
+                ('bytes=100-', (100, 1000)),
+                ('bytes=-100', (900, 1000)),
+                ('bytes=-2000', (0, 1000)),
+                ('bytes=900-2000', (900, 1000)),
+                ('bytes = 1 - 2', (1, 3)),
+                ('bytes=5-3', None),
+                ('bytes=0-1,5-6', None),
+                ('bytes=-', None),
+                ('items=0-1', None),
+                ('', None)):
+            self.assertEqual(parse_range(header, 1000), byte_range, header)
+        for header in ('bytes=1000-', 'bytes=-0'):
+            with self.assertRaises(ValueError):
+                parse_range(header, 1000)
+
+    def test_ranges(self):
+        data = os.urandom(3 * settings.SEGMENT_SIZE + 100)
+        file_id = self.upload_file(data)
+        for header, status, expected in (
+                ('bytes=10-20', 206, data[10:21]),
+                ('bytes=%d-' % settings.SEGMENT_SIZE, 206,
+                 data[settings.SEGMENT_SIZE:]),
+                ('bytes=-150', 206, data[-150:]),
+                ('bytes=5-3', 200, data),
+                ('bytes=0-1,5-6', 200, data)):
+            response = self.download(file_id, HTTP_RANGE=header)
+            self.assertEqual(response.status_code, status, header)
+            self.assertEqual(
+                ''.join(response.streaming_content), expected, header)
+        response = self.download(file_id, HTTP_RANGE='bytes=-50')
+        self.assertEqual(response['Content-Range'], 'bytes %d-%d/%d' % (
+            len(data) - 50, len(data) - 1, len(data)))
+        response.close()
+
+    def test_unsatisfiable_range(self):
+        file_id = self.upload_file('data')
+        opened = []
+        open_ = EncryptedFileSystemStorage.open
+
+        def open_file(storage, *args, **kwargs):
+            opened.append(open_(storage, *args, **kwargs))
+            return opened[-1]
+        EncryptedFileSystemStorage.open = open_file
+        try:
+            response = self.download(file_id, HTTP_RANGE='bytes=10-')
+        finally:
+            EncryptedFileSystemStorage.open = open_
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */4')
+        self.assertTrue(opened[0].file.closed)
+
+
+class OffsetFile(object):
+    ''' read-only file holding data at offset, after zeros '''
+
+    def __init__(self, offset, data):
+        self.offset = offset
+        self.data = data
+        self.position = 0
+
+    def seek(self, position, whence=0):
+        if whence == 1:
+            position += self.position
+        elif whence == 2:
+            position += self.offset + len(self.data)
+        self.position = position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        end = self.offset + len(self.data)
+        if size < 0 or self.position + size > end:
+            size = max(end - self.position, 0)
+        start, self.position = self.position, self.position + size
+        zeros = max(min(self.offset, self.position) - start, 0)
+        return '\x00' * zeros + self.data[
+            max(start - self.offset, 0):self.position - self.offset]
+
+
+class ZipStreamTest(SimpleTestCase):
+
+    files = [(u'caf\xe9.txt', os.urandom(10)), ('a/b.bin', os.urandom(70000)),
+             ('a/b.bin', ''), ('', 'x')]
+
+    def archive(self, stream):
+        return ''.join(
+            [chunk for name, data in self.files for chunk in
+             stream.entry(name, len(data), [data[:5], data[5:]])] +
+            list(stream.close()))
+
+    def check(self, archive):
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(
+            [archive.read(name) for name in archive.namelist()],
+            [data for name, data in self.files])
+        self.assertEqual(len(set(archive.namelist())), len(self.files))
+
+    def test_archive(self):
+        self.check(zipfile.ZipFile(io.BytesIO(self.archive(ZipStream()))))
+
+    def test_zip64_offsets(self):
+        ''' entries and central directory past 4 GB '''
+        stream = ZipStream()
+        stream.offset = ZIP64_LIMIT + 10
+        archive = zipfile.ZipFile(
+            OffsetFile(stream.offset, self.archive(stream)))
+        self.assertEqual(archive.infolist()[0].header_offset, ZIP64_LIMIT + 10)
+        self.check(archive)
+
+    def test_size_mismatch(self):
+        with self.assertRaises(ValueError):
+            list(ZipStream().entry('a', 3, ['ab']))
+
+
+class BrokenStream(object):
+    ''' request body whose connection is lost after data '''
+
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if not data:
+            raise IOError('Connection lost')
+        return data
+
+
+class UploadSessionTest(StorageTestCase):
+
+    def create_session(self, length, part_size=0):
+        response = self.client.post(
+            reverse('secure-storage-upload-sessions'), {
+                'passphrase': PASSPHRASE, 'expire_date': '3600',
+                'filename': 'data.bin', 'length': length,
+                'part_size': part_size})
+        self.assertEqual(response.status_code, 201)
+        return json.loads(response.content)['session_id']
+
+    def session_url(self, session_id):
+        return reverse('secure-storage-upload-session', args=[session_id])
+
+    def patch(self, session_id, offset, data):
+        return self.client.generic(
+            'PATCH', self.session_url(session_id), data,
+            content_type='application/offset+octet-stream',
+            HTTP_UPLOAD_OFFSET=str(offset), HTTP_X_PASSPHRASE=PASSPHRASE)
+
+    def head_offset(self, session_id):
+        response = self.client.head(self.session_url(session_id))
+        self.assertEqual(response.status_code, 200)
+        return int(response['Upload-Offset'])
+
+    def complete(self, session_id):
+        response = self.client.post(self.session_url(session_id))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)['file_id']
+
+    def test_resume_after_interruption(self):
+        segment_size = settings.SEGMENT_SIZE
+        data = os.urandom(3 * segment_size + 100)
+        session_id = self.create_session(len(data))
+
+        # Cut short within the third segment
+        session = UploadSession.objects.get(session_id=session_id)
+        offset = session.append(
+            PASSPHRASE, BrokenStream(data[:2 * segment_size + 500]), 0)
+        self.assertEqual(offset, 2 * segment_size)
+        self.assertEqual(self.head_offset(session_id), 2 * segment_size)
+
+        # Not from the offset the upload is at
+        response = self.patch(session_id, 2 * segment_size + 500, data[:10])
+        self.assertEqual(response.status_code, 409)
+
+        response = self.patch(session_id, offset, data[offset:])
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(int(response['Upload-Offset']), len(data))
+        self.assertEqual(self.head_offset(session_id), len(data))
+        file_id = self.complete(session_id)
+        self.assertEqual(self.download_content(file_id), data)
+
+    def test_partial_segment(self):
+        ''' a request ending within a segment keeps the whole ones '''
+        segment_size = settings.SEGMENT_SIZE
+        data = os.urandom(2 * segment_size)
+        session_id = self.create_session(len(data))
+        response = self.patch(session_id, 0, data[:segment_size + 10])
+        self.assertEqual(int(response['Upload-Offset']), segment_size)
+        response = self.client.post(self.session_url(session_id))
+        self.assertEqual(response.status_code, 409)
+        self.patch(session_id, segment_size, data[segment_size:])
+        file_id = self.complete(session_id)
+        self.assertEqual(self.download_content(file_id), data)
+
+    def put_part(self, session_id, number, data):
+        return self.client.generic(
+            'PUT', reverse('secure-storage-upload-session-part',
+                           args=[session_id, number]), data,
+            content_type='application/octet-stream',
+            HTTP_X_PASSPHRASE=PASSPHRASE)
+
+    def test_parts_out_of_order(self):
+        part_size = settings.SEGMENT_SIZE
+        data = os.urandom(3 * part_size + 100)
+        parts = [data[start:start + part_size]
+                 for start in range(0, len(data), part_size)]
+        session_id = self.create_session(len(data), part_size)
+        for number in (3, 1, 0):
+            response = self.put_part(session_id, number, parts[number])
+            self.assertEqual(response.status_code, 204)
+        response = self.client.head(self.session_url(session_id))
+        self.assertEqual(response['Upload-Parts'], '0,1,3')
+        response = self.client.post(self.session_url(session_id))
+        self.assertEqual(response.status_code, 409)
+
+        self.put_part(session_id, 2, parts[2])
+        file_id = self.complete(session_id)
+        self.assertEqual(self.download_content(file_id), data)
+
+    def test_late_part_is_swept(self):
+        ''' a part finishing after its upload was assembled is removed by
+        clean_secure_storage, and the file kept '''
+        part_size = settings.SEGMENT_SIZE
+        data = os.urandom(2 * part_size)
+        session_id = self.create_session(len(data), part_size)
+        session = UploadSession.objects.get(session_id=session_id)
+        self.put_part(session_id, 0, data[:part_size])
+        self.put_part(session_id, 1, data[part_size:])
+        file_id = self.complete(session_id)
+
+        session.write_part(PASSPHRASE, 1, io.BytesIO(data[part_size:]))
+        self.assertIn(file_id + '.part1', self.stored_files())
+        call_command('clean_secure_storage', min_age=0, stdout=io.BytesIO())
+        self.assertNotIn(file_id + '.part1', self.stored_files())
+        self.assertEqual(self.download_content(file_id), data)
+
+
+class Base64DecoderTest(SimpleTestCase):
+
+    def decode(self, chunks):
+        decoder = Base64Decoder()
+        return ''.join(decoder.decode(chunk) for chunk in chunks) + \
+            decoder.flush()
+
+    def test_split_quantum(self):
+        ''' chunks ending anywhere within a 4-character quantum '''
+        data = os.urandom(31)
+        encoded = base64.b64encode(data)
+        for split in range(len(encoded) + 1):
+            self.assertEqual(
+                self.decode([encoded[:split], encoded[split:]]), data)
+        self.assertEqual(self.decode(
+            [memoryview(encoded[i:i + 3]) for i in range(0, len(encoded), 3)]),
+            data)
+
+    def test_line_breaks_and_padding(self):
+        for size in (0, 1, 2, 3, 100):
+            data = os.urandom(size)
+            encoded = base64.encodestring(data).replace('\n', '\r\n')
+            for split in range(len(encoded) + 1):
+                self.assertEqual(self.decode(
+                    [encoded[:split], encoded[split:], '\r\n']), data)
+
+    def test_truncated(self):
+        encoded = base64.b64encode('data')
+        with self.assertRaises(ValueError):
+            self.decode([encoded[:-1]])
@@ -1,14 +1,15 @@
 
-import base64
 from django.core.files.uploadhandler import FileUploadHandler, StopUpload
 from django.utils.datastructures import MultiValueDict
 from django.http.multipartparser import (
-    LazyStream, ChunkIter, MultiPartParserError, Parser, FIELD, FILE, exhaust)
+    MultiPartParserError, FIELD, FILE, exhaust)
 from django.utils.encoding import force_text
 from django.utils.text import unescape_entities
 from django.core.files.uploadhandler import SkipFile
 
 import app_settings as settings
+from .metrics import NULL, start_transfer, timed
+from .multipart import Base64Decoder, MultiPartScanner
 from .storage import EncryptedUploadedFile
 
 
@@ -22,6 +23,9 @@ class IntelligentUploadHandler(FileUploadHandler):
     for real and true awesomeness.
     """
 
+    # Transfer the parsing stages are timed in, see metrics.py
+    metrics = NULL
+
     def __init__(self, *args, **kwargs):
         super(IntelligentUploadHandler, self).__init__(*args, **kwargs)
 
@@ -33,6 +37,13 @@ class IntelligentUploadHandler(FileUploadHandler):
         """
         pass
 
+    def file_aborted(self):
+        """
+        A callback method triggered when the file being received is dropped,
+        skipped or cut short.
+        """
+        pass
+
     def handle_raw_input(
             self, input_data, META, content_length, boundary, encoding=None):
         """
@@ -50,26 +61,26 @@ class IntelligentUploadHandler(FileUploadHandler):
         self.POST = QueryDict('', mutable=True)
         self.FILES = MultiValueDict()
 
-        # initialize the parser and stream
-        stream = LazyStream(ChunkIter(input_data, self.chunk_size))
         # whether or not to signal a file-completion at the beginning
         # of the loop.
         old_field_name = None
         counter = 0
 
         try:
-            for item_type, meta_data, field_stream in Parser(stream, boundary):
+            # file data comes in AES compatible blocks (multiples of 16
+            # bytes), except for the last one of each part.
+            scanner = MultiPartScanner(input_data, boundary)
+            parts = scanner
+            if self.metrics:
+                scanner.metrics = self.metrics
+                parts = timed(scanner, self.metrics, 'parse', ('read',))
+            for item_type, meta_data, field_stream in parts:
                 if old_field_name:
                     # we run this test at the beginning of the next loop since
                     # we cannot be sure a file is complete until we hit the
                     # next boundary/part of the multipart content.
-                    file_obj = self.file_complete(counter)
-
-                    if file_obj:
-                        # if we return a file object, add it to the files dict
-                        self.FILES.appendlist(force_text(
-                            old_field_name, encoding,
-                            errors='replace'), file_obj)
+                    self.handle_file_complete(
+                        old_field_name, counter, encoding)
 
                     # wipe it out to prevent havoc
                     old_field_name = None
@@ -90,9 +101,10 @@ class IntelligentUploadHandler(FileUploadHandler):
                     # this is a POST field
                     if transfer_encoding == "base64":
                         raw_data = field_stream.read()
+                        decoder = Base64Decoder()
                         try:
-                            data = str(raw_data).decode('base64')
-                        except:
+                            data = decoder.decode(raw_data) + decoder.flush()
+                        except ValueError:
                             data = raw_data
                     else:
                         data = field_stream.read()
@@ -140,21 +152,23 @@ class IntelligentUploadHandler(FileUploadHandler):
                             'charset': charset}
                         self.new_file(field_name, file_name, **kwargs)
 
+                        decoder = None
+                        if transfer_encoding == "base64":
+                            decoder = Base64Decoder()
+
+                        chunks = field_stream
+                        if self.metrics:
+                            chunks = timed(
+                                field_stream, self.metrics, 'parse',
+                                ('read',))
+
                         # chubber-chunk it
-                        for chunk in field_stream:
-                            # we need AES compatibles blocks (multiples of 16 bits)
-                            over_bytes = len(chunk) % 16
-                            if over_bytes:
-                                over_chunk =\
-                                    field_stream.read(16 - over_bytes)
-                                chunk += over_chunk
-
-                            if transfer_encoding == "base64":
+                        for chunk in chunks:
+                            if decoder:
                                 try:
-                                    chunk = base64.b64decode(chunk)
-                                except Exception as e:
-                                    # since this is anly a chunk, any
-                                    # error is an unfixable error
+                                    chunk = decoder.decode(chunk)
+                                except ValueError as e:
+                                    # any error is an unfixable error
                                     raise MultiPartParserError(
                                         "Could not decode base64 data: %r" % e)
 
@@ -165,13 +179,30 @@ class IntelligentUploadHandler(FileUploadHandler):
                             if counter > settings.UPLOAD_FILE_SIZE_LIMIT:
                                 raise SkipFile('File is too big.')
                             # ... and we're done
+                        if decoder:
+                            try:
+                                decoder.flush()
+                            except ValueError as e:
+                                raise MultiPartParserError(
+                                    "Could not decode base64 data: %r" % e)
+                        if field_stream.truncated:
+                            # the client went away mid-file
+                            raise SkipFile('File is truncated.')
                     except SkipFile:
+                        self.file_aborted()
                         # just eat the rest
-                        exhaust(field_stream)
+                        field_stream.exhaust()
+                    except:
+                        self.file_aborted()
+                        raise
                     else:
                         # handle file upload completions on next iteration
                         old_field_name = field_name
 
+            if old_field_name:
+                # the last part was a file
+                self.handle_file_complete(old_field_name, counter, encoding)
+
         except StopUpload as e:
             # if we get a request to stop the upload,
             # exhaust it if no con reset
@@ -186,6 +217,14 @@ class IntelligentUploadHandler(FileUploadHandler):
 
         return self.POST, self.FILES
 
+    def handle_file_complete(self, old_field_name, counter, encoding):
+        file_obj = self.file_complete(counter)
+
+        if file_obj:
+            # if we return a file object, add it to the files dict
+            self.FILES.appendlist(force_text(
+                old_field_name, encoding, errors='replace'), file_obj)
+
     def IE_sanitize(self, filename):
         """Cleanup filename from Internet Explorer full paths."""
         return filename and filename[filename.rfind("\\") + 1:].strip()
@@ -200,6 +239,7 @@ class SecureFileUploadHandler(IntelligentUploadHandler):
         self.passphrase = None
         self.expire_date = None
         self.one_time = False
+        self.file = None
 
     def handle_raw_input(
             self, input_data, META, content_length, boundary, encoding=None):
@@ -208,8 +248,12 @@ class SecureFileUploadHandler(IntelligentUploadHandler):
         if content_length > settings.UPLOAD_FILE_SIZE_LIMIT:
             raise SkipFile
 
-        return super(SecureFileUploadHandler, self).handle_raw_input(
-            input_data, META, content_length, boundary, encoding)
+        self.metrics = start_transfer('upload')
+        try:
+            return super(SecureFileUploadHandler, self).handle_raw_input(
+                input_data, META, content_length, boundary, encoding)
+        finally:
+            self.metrics.finish()
 
     def field_parsed(self, field_name, field_value):
 
@@ -227,23 +271,35 @@ class SecureFileUploadHandler(IntelligentUploadHandler):
 
     def new_file(self, field_name, file_name, *args, **kwargs):
 
+        self.file = None
         super(SecureFileUploadHandler, self).new_file(
             field_name, file_name, *args, **kwargs)
 
         if self.passphrase:
             kwargs['clear_filename'] = file_name
-            for attr in ('passphrase', 'expire_date', 'one_time'):
+            for attr in ('passphrase', 'expire_date', 'one_time', 'metrics'):
                 kwargs[attr] = getattr(self, attr, None)
+            # The file is at most as long as the request
+            kwargs['expected_size'] = self.content_length
             self.file = EncryptedUploadedFile(*args, **kwargs)
         else:
             raise SkipFile('No passphrase')
 
+    def file_aborted(self):
+
+        # Never renamed into place, nor served
+        if self.file is not None:
+            self.file.discard()
+            self.file = None
+
     def file_complete(self, file_size):
 
+        # Metadata is written once the size is known: a single INSERT
+        self.file.size = file_size
+        self.file.finalize()
         self.file.seek(0)
         from .models import EncryptedUploadedFileMetaData
-        EncryptedUploadedFileMetaData.update(self.file, size=file_size)
-        self.file.size = file_size
+        EncryptedUploadedFileMetaData.save_(self.file)
         return self.file
 
     def upload_complete(self):
@@ -1,5 +1,9 @@
 from django.conf.urls import patterns, url
-from .views import UploadSecureStorageView, DownloadSecureStorageView
+from django.views.decorators.csrf import csrf_exempt
+from .views import (
+    UploadSecureStorageView, UploadSessionCreateView, UploadSessionView,
+    UploadSessionPartView, DownloadSecureStorageView,
+    BatchDownloadSecureStorageView, MetricsView)
 
 urlpatterns = patterns(
     '',
@@ -7,7 +11,28 @@ urlpatterns = patterns(
         UploadSecureStorageView.as_view(),
         name='secure-storage-upload'),
 
+    url(r'^upload/sessions/$',
+        csrf_exempt(UploadSessionCreateView.as_view()),
+        name='secure-storage-upload-sessions'),
+
+    url(r'^upload/sessions/(?P<session_id>[0-9a-f]{32})/$',
+        csrf_exempt(UploadSessionView.as_view()),
+        name='secure-storage-upload-session'),
+
+    url(r'^upload/sessions/(?P<session_id>[0-9a-f]{32})/parts/'
+        r'(?P<number>\d+)/$',
+        csrf_exempt(UploadSessionPartView.as_view()),
+        name='secure-storage-upload-session-part'),
+
     url(r'^download/$',
         DownloadSecureStorageView.as_view(),
         name='secure-storage-download'),
+
+    url(r'^download/batch/$',
+        BatchDownloadSecureStorageView.as_view(),
+        name='secure-storage-download-batch'),
+
+    url(r'^metrics/$',
+        MetricsView.as_view(),
+        name='secure-storage-metrics'),
 )
@@ -1,16 +1,86 @@
 
 import json
+import re
+from functools import wraps
 
 from django.http import HttpResponse, HttpResponseBadRequest
 from django.http import StreamingHttpResponse
-from django.http import HttpResponseServerError, Http404
+from django.http import HttpResponseServerError, HttpResponseForbidden, Http404
 
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
 
-from .forms import UploadFileForm, DownloadFileForm
+from django.core.urlresolvers import reverse
+
+from .admission import Overloaded, admit
+from .forms import (
+    UploadFileForm, UploadSessionForm, DownloadFileForm, BatchDownloadForm)
+from .models import EncryptedUploadedFileMetaData, UploadSession
 from .upload_handlers import SecureFileUploadHandler
-from .storage import EncryptedFileSystemStorage, InexistentFile
+from .storage import (
+    EncryptedFileSystemStorage, EncryptedUploadedFile, ExpiredFile,
+    InexistentFile, UploadConflict, WrongPassphrase)
+from .metrics import PrometheusSink, get_sink, start_transfer
+from .streaming import PipelinedIterator
+from .zipstream import ZipStream
+import app_settings as settings
+
+
+class HttpResponseConflict(HttpResponse):
+    status_code = 409
+
+
+def admitted(method):
+    ''' runs an upload view method once admission control lets the upload
+    in, answers 503 before its body is read otherwise '''
+
+    @wraps(method)
+    def wrapper(self, request, *args, **kwargs):
+        try:
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            # Unknown, as Django reads it
+            length = 0
+        try:
+            admission = admit(length)
+        except Overloaded as e:
+            response = HttpResponse(
+                json.dumps(dict(error=str(e))), status=503,
+                content_type='application/json')
+            response['Retry-After'] = settings.UPLOAD_RETRY_AFTER
+            return response
+        try:
+            return method(self, request, *args, **kwargs)
+        finally:
+            admission.release()
+    return wrapper
+
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header, size):
+    ''' returns the (start, stop) clear bytes requested by a Range header,
+    or None if the header should be ignored. Raises ValueError if the range
+    cannot be satisfied. '''
+
+    match = RANGE_RE.match(header.replace(' ', ''))
+    if not match or match.groups() == ('', ''):
+        # Malformed or multiple ranges: serve the whole file
+        return None
+    first, last = match.groups()
+    if first and last and int(last) < int(first):
+        # Invalid rather than unsatisfiable (RFC 7233, 2.1)
+        return None
+    if not first:
+        # Suffix range: the last bytes of the file
+        start, stop = max(size - int(last), 0), size
+    else:
+        start = int(first)
+        stop = min(int(last) + 1, size) if last else size
+    if start >= stop:
+        raise ValueError('Unsatisfiable range')
+    return start, stop
 
 
 class SecureStorageView(View):
@@ -40,10 +110,11 @@ class UploadSecureStorageView(SecureStorageView):
 
     def get_response(self, request, form):
 
-        try:
-            expire_on = request.FILES['file'].expire_date.isoformat()
-        except AttributeError:
+        if request.FILES['file'].one_time:
+            # Kept until then, or until the default expiry date
             expire_on = 'first download'
+        else:
+            expire_on = request.FILES['file'].expire_date.isoformat()
         content = json.dumps(dict(
             file_id=request.FILES['file'].name,
             size=request.FILES['file'].size,
@@ -51,11 +122,138 @@ class UploadSecureStorageView(SecureStorageView):
         return HttpResponse(content, content_type='application/json')
 
     @csrf_exempt
+    @admitted
     def post(self, request, *args, **kwargs):
         request.upload_handlers = [SecureFileUploadHandler(), ]
         return super(UploadSecureStorageView, self).post(request, *args, **kwargs)
 
 
+class UploadSessionCreateView(SecureStorageView):
+    ''' Starts a resumable upload, see UploadSessionView. '''
+
+    def get_form(self, request):
+        return UploadSessionForm(request.POST)
+
+    def get_response(self, request, form):
+
+        data = form.cleaned_data
+        session = UploadSession.create_(
+            data['passphrase'], data['filename'], data['content_type'],
+            data['length'], data['expire_date'],
+            int(data['expire_date']) == settings.ONE_TIME,
+            data['part_size'])
+        content = json.dumps(dict(
+            session_id=session.session_id,
+            segment_size=session.segment_size,
+            offset=session.offset,
+            part_size=session.part_size))
+        response = HttpResponse(
+            content, status=201, content_type='application/json')
+        response['Location'] = reverse(
+            'secure-storage-upload-session', args=[session.session_id])
+        return response
+
+
+class UploadSessionView(View):
+    ''' tus-like resumable upload session.
+
+    HEAD returns the offset to resume the upload from, PATCH sends data
+    (application/offset+octet-stream) from the Upload-Offset header on, with
+    the passphrase in the X-Passphrase header, and POST completes the upload.
+    Data is stored in whole segments: the offset returned by PATCH may be
+    less than what was sent.
+
+    Sessions created with a part size get their data in parts instead, see
+    UploadSessionPartView, and HEAD lists the parts received. '''
+
+    def error(self, response_class, message):
+        return response_class(json.dumps(dict(error=message)))
+
+    def head(self, request, session_id):
+
+        try:
+            session = UploadSession.get_(session_id)
+        except (InexistentFile, ExpiredFile):
+            raise Http404
+        response = HttpResponse()
+        response['Upload-Offset'] = session.offset
+        response['Upload-Length'] = session.length
+        if session.part_size:
+            response['Upload-Parts'] = ','.join(
+                str(number) for number in session.parts_done())
+        response['Cache-Control'] = 'no-store'
+        return response
+
+    @admitted
+    def patch(self, request, session_id):
+
+        if request.META.get('CONTENT_TYPE') != \
+                'application/offset+octet-stream':
+            return HttpResponse(status=415)
+        try:
+            offset = int(request.META['HTTP_UPLOAD_OFFSET'])
+        except (KeyError, ValueError):
+            return self.error(HttpResponseBadRequest, 'Invalid Upload-Offset')
+
+        try:
+            session = UploadSession.get_(session_id)
+            offset = session.append(
+                request.META.get('HTTP_X_PASSPHRASE', ''), request, offset)
+        except (InexistentFile, ExpiredFile):
+            raise Http404
+        except WrongPassphrase:
+            return self.error(HttpResponseForbidden, 'Wrong passphrase')
+        except UploadConflict as e:
+            return self.error(HttpResponseConflict, str(e))
+
+        response = HttpResponse(status=204)
+        response['Upload-Offset'] = offset
+        return response
+
+    def post(self, request, session_id):
+
+        try:
+            session = UploadSession.get_(session_id)
+            metadata = session.complete()
+        except (InexistentFile, ExpiredFile):
+            raise Http404
+        except UploadConflict as e:
+            return self.error(HttpResponseConflict, str(e))
+
+        if metadata.one_time:
+            expire_on = 'first download'
+        else:
+            expire_on = metadata.expire_date.isoformat()
+        content = json.dumps(dict(
+            file_id=metadata.file_id,
+            size=session.length,
+            expire_on=expire_on))
+        return HttpResponse(content, content_type='application/json')
+
+
+class UploadSessionPartView(UploadSessionView):
+    ''' PUT sends part number of a multi-part upload session, at once. Parts
+    can be sent in any order and at the same time. '''
+
+    http_method_names = ['put']
+
+    @admitted
+    def put(self, request, session_id, number):
+
+        try:
+            session = UploadSession.get_(session_id)
+            session.write_part(
+                request.META.get('HTTP_X_PASSPHRASE', ''), int(number),
+                request)
+        except (InexistentFile, ExpiredFile):
+            raise Http404
+        except WrongPassphrase:
+            return self.error(HttpResponseForbidden, 'Wrong passphrase')
+        except UploadConflict as e:
+            return self.error(HttpResponseConflict, str(e))
+        return HttpResponse(status=204)
+
+
 class DownloadSecureStorageView(SecureStorageView):
 
     def get_form(self, request):
@@ -63,25 +261,153 @@ class DownloadSecureStorageView(SecureStorageView):
 
     def add_headers(self, response, content=None):
 
-        # response['Content-Length'] = content.size or 0
+        response['Accept-Ranges'] = 'bytes'
         response['Content-Disposition'] = \
             'attachment; filename=%s' % content.clear_filename
         response['Content-Type'] = content.content_type
         return response
 
+    def get_streaming_content(self, content, start=0, stop=None):
+
+        return self.pipeline(content.chunks(start=start, stop=stop))
+
+    def pipeline(self, chunks):
+
+        if settings.DOWNLOAD_PIPELINE_DEPTH:
+            chunks = PipelinedIterator(
+                chunks, settings.DOWNLOAD_PIPELINE_DEPTH,
+                settings.DOWNLOAD_PIPELINE_MAX_BYTES)
+        return chunks
+
     def get_response(self, request, form):
 
         try:
 
             file_id = form.cleaned_data['file_id']
             passphrase = form.cleaned_data['passphrase']
+            transfer = start_transfer('download')
             content = EncryptedFileSystemStorage()\
-                .open(name=file_id, passphrase=passphrase)
-            response = StreamingHttpResponse(streaming_content=content.chunks())
+                .open(name=file_id, passphrase=passphrase, metrics=transfer)
+            size = content.size or 0
+
+            try:
+                byte_range = parse_range(
+                    request.META.get('HTTP_RANGE', ''), size)
+            except ValueError:
+                content.close()
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */%d' % size
+                return response
+
+            if byte_range:
+                start, stop = byte_range
+                response = StreamingHttpResponse(
+                    streaming_content=transfer.wrap(
+                        self.get_streaming_content(content, start, stop)),
+                    status=206)
+                response['Content-Range'] = 'bytes %d-%d/%d' % (
+                    start, stop - 1, size)
+            else:
+                start, stop = 0, size
+                response = StreamingHttpResponse(
+                    streaming_content=transfer.wrap(
+                        self.get_streaming_content(content)))
+            response['Content-Length'] = stop - start
             return self.add_headers(response, content)
 
-        except InexistentFile:
+        except (InexistentFile, ExpiredFile):
             raise Http404
 
+        except WrongPassphrase:
+            content = json.dumps(dict(error='Wrong passphrase'))
+            return HttpResponseForbidden(content)
+
+
+class BatchDownloadSecureStorageView(DownloadSecureStorageView):
+    ''' Streams several files as a single ZIP archive. The metadata of all
+    the files is loaded at once and every passphrase is checked before
+    anything is sent. One-time files are opened before they are claimed, the
+    others only while they are streamed. '''
+
+    def get_form(self, request):
+        return BatchDownloadForm(request.POST)
 
+    def get_streaming_content(self, storage, files, rows, opened, transfer):
 
+        archive = ZipStream()
+        try:
+            for index, (file_id, passphrase) in enumerate(files):
+                content = opened.pop(index, None) or storage.open(
+                    name=file_id, passphrase=passphrase,
+                    metadata=rows[file_id], claim=False, metrics=transfer)
+                try:
+                    for chunk in archive.entry(
+                            content.clear_filename, content.size or 0,
+                            content.chunks()):
+                        yield chunk
+                finally:
+                    content.close()
+            for chunk in archive.close():
+                yield chunk
+        finally:
+            for content in opened.values():
+                content.close()
+
+    def get_response(self, request, form):
+
+        storage = EncryptedFileSystemStorage()
+        files = zip(form.cleaned_data['file_id'],
+                    form.cleaned_data['passphrase'])
+        transfer = start_transfer('batch')
+        rows = EncryptedUploadedFileMetaData.get_many(
+            [file_id for file_id, passphrase in files])
+        opened = {}
+        try:
+            for file_id, passphrase in files:
+                if file_id not in rows:
+                    raise InexistentFile
+                EncryptedUploadedFile.check(file_id, passphrase, rows[file_id])
+            # One-time files are only claimed once all are checked, and
+            # opened first: without metadata, they may be removed (by the
+            # reaper or clean_secure_storage) before their turn comes.
+            for index, (file_id, passphrase) in enumerate(files):
+                if rows[file_id].one_time:
+                    opened[index] = storage.open(
+                        name=file_id, passphrase=passphrase,
+                        metadata=rows[file_id], claim=False,
+                        metrics=transfer)
+            if opened and not EncryptedUploadedFileMetaData.claim_many(
+                    [files[index][0] for index in opened]):
+                raise InexistentFile
+
+        except (InexistentFile, ExpiredFile):
+            for content in opened.values():
+                content.close()
+            raise Http404
+
+        except WrongPassphrase:
+            for content in opened.values():
+                content.close()
+            content = json.dumps(dict(error='Wrong passphrase'))
+            return HttpResponseForbidden(content)
+
+        response = StreamingHttpResponse(
+            streaming_content=transfer.wrap(self.pipeline(
+                self.get_streaming_content(
+                    storage, files, rows, opened, transfer))),
+            content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename=files.zip'
+        return response
+
+
+class MetricsView(View):
+    ''' Serves the transfer metrics in the Prometheus text format, when
+    app_settings.METRICS_SINK is 'prometheus' '''
+
+    def get(self, request):
+
+        sink = get_sink()
+        if not isinstance(sink, PrometheusSink):
+            raise Http404
+        return HttpResponse(
+            sink.render(), content_type='text/plain; version=0.0.4')
@@ -0,0 +1,131 @@
+''' Streaming ZIP writer.
+
+Entries are stored (not compressed) and written one after another as their
+data comes, with the CRC in a data descriptor after the data, so that the
+archive is never held on disk or in memory. Sizes are known up front; ZIP64
+records are used for entries, offsets and archives past the 32-bit limits.
+'''
+
+import struct
+import time
+import zlib
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+
+# General purpose flags: sizes and CRC in a data descriptor, UTF-8 names
+FLAGS = 0x08 | 0x800
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+DATA_DESCRIPTOR = struct.Struct('<IIII')
+DATA_DESCRIPTOR64 = struct.Struct('<IIQQ')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+END_RECORD = struct.Struct('<IHHHHIIH')
+END_RECORD64 = struct.Struct('<IQHHIIQQQQ')
+END_LOCATOR64 = struct.Struct('<IIQI')
+
+
+def dos_date_time(timestamp=None):
+    ''' returns the (time, date) of timestamp in MS-DOS format '''
+    t = time.localtime(timestamp)
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((max(t.tm_year, 1980) - 1980) << 9) | (t.tm_mon << 5) |
+            t.tm_mday)
+
+
+class ZipStream(object):
+    ''' Writes a ZIP archive as a sequence of strings: entry() yields the
+    records and data of one file, close() the central directory. '''
+
+    def __init__(self):
+        self.offset = 0
+        self.entries = []
+        self.names = set()
+
+    def _emit(self, data):
+        self.offset += len(data)
+        return data
+
+    def unique_name(self, name):
+        ''' returns name, made unique within the archive and flat '''
+        name = name.replace('/', '_').replace('\\', '_') or 'file'
+        base, dot, extension = name.rpartition('.')
+        if not base:
+            base, dot, extension = extension, '', ''
+        candidate, count = name, 1
+        while candidate in self.names:
+            count += 1
+            candidate = '%s (%d)%s%s' % (base, count, dot, extension)
+        self.names.add(candidate)
+        return candidate
+
+    def entry(self, name, size, chunks, timestamp=None):
+        ''' yields an entry of size bytes named name, with the data of
+        chunks. Raises ValueError if chunks does not hold size bytes. '''
+        name = self.unique_name(name)
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        zip64 = size >= ZIP64_LIMIT
+        mod_time, mod_date = dos_date_time(timestamp)
+        offset = self.offset
+        extra = ''
+        if zip64:
+            # Sizes are in the data descriptor, the extra field holds 0s
+            extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+        yield self._emit(LOCAL_HEADER.pack(
+            0x04034b50, 45 if zip64 else 20, FLAGS, 0, mod_time, mod_date,
+            0, ZIP64_LIMIT if zip64 else 0, ZIP64_LIMIT if zip64 else 0,
+            len(name), len(extra)) + name + extra)
+
+        crc = 0
+        written = 0
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            written += len(chunk)
+            yield self._emit(chunk)
+        if written != size:
+            raise ValueError('%s is %d bytes long, not %d' % (
+                name, written, size))
+        crc &= 0xFFFFFFFF
+
+        if zip64:
+            descriptor = DATA_DESCRIPTOR64.pack(0x08074b50, crc, size, size)
+        else:
+            descriptor = DATA_DESCRIPTOR.pack(0x08074b50, crc, size, size)
+        yield self._emit(descriptor)
+        self.entries.append((name, size, crc, offset, mod_time, mod_date))
+
+    def close(self):
+        ''' yields the central directory and end records '''
+        start = self.offset
+        for name, size, crc, offset, mod_time, mod_date in self.entries:
+            extra = ''
+            zip64 = size >= ZIP64_LIMIT or offset >= ZIP64_LIMIT
+            if zip64:
+                values = []
+                if size >= ZIP64_LIMIT:
+                    values += [size, size]
+                if offset >= ZIP64_LIMIT:
+                    values.append(offset)
+                extra = struct.pack(
+                    '<HH%dQ' % len(values), 1, 8 * len(values), *values)
+            yield self._emit(CENTRAL_HEADER.pack(
+                0x02014b50, (3 << 8) | 45, 45 if zip64 else 20, FLAGS, 0,
+                mod_time, mod_date, crc,
+                min(size, ZIP64_LIMIT), min(size, ZIP64_LIMIT),
+                len(name), len(extra), 0, 0, 0, 0o100600 << 16,
+                min(offset, ZIP64_LIMIT)) + name + extra)
+
+        count = len(self.entries)
+        size = self.offset - start
+        if count >= ZIP_FILECOUNT_LIMIT or size >= ZIP64_LIMIT or \
+                start >= ZIP64_LIMIT:
+            end64 = self.offset
+            yield self._emit(END_RECORD64.pack(
+                0x06064b50, END_RECORD64.size - 12, 45, 45, 0, 0, count,
+                count, size, start))
+            yield self._emit(END_LOCATOR64.pack(0x07064b50, 0, end64, 1))
+        yield self._emit(END_RECORD.pack(
+            0x06054b50, 0, 0, min(count, ZIP_FILECOUNT_LIMIT),
+            min(count, ZIP_FILECOUNT_LIMIT), min(size, ZIP64_LIMIT),
+            min(start, ZIP64_LIMIT), 0))